@@ -0,0 +1,401 @@
+#!/usr/bin/env python
+#
+#  benchmark_icon_builder.py
+"""
+Benchmarks for ``gnome_icon_builder``.
+
+Generates synthetic source SVGs in the baseplate layout, then builds them with each backend and number of workers,
+recording the throughput, peak memory use and time spent in each stage over several runs.
+
+e.g.
+
+	python benchmark_icon_builder.py --icons 50 --backends inkscape cairosvg --workers 1 4 --output results.json
+
+Each run is made in a new process, with an empty output directory and without the build cache,
+so the runs are independent of each other and of any previous builds.
+"""
+#
+#  Copyright 2020 Dominic Davis-Foster <dominic@davis-foster.co.uk>
+#
+#  This program is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU Lesser General Public License as published by
+#  the Free Software Foundation; either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU Lesser General Public License for more details.
+#
+#  You should have received a copy of the GNU Lesser General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+#  MA 02110-1301, USA.
+#
+
+# stdlib
+import argparse
+import json
+import os
+import pathlib
+import platform
+import random
+import resource
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+# 3rd party
+from lxml import etree
+
+# this package
+import gnome_icon_builder
+from gnome_icon_builder import INKSCAPE, SVG
+
+SODIPODI = "http://sodipodi.sourceforge.net/DTD/sodipodi-0.dtd"
+
+CONTEXTS = ["actions", "apps", "categories", "devices", "mimetypes", "places", "status"]
+
+
+def make_path(rng, x, y, size, complexity):
+	"""
+	Returns the ``d`` attribute of a random closed path of ``complexity`` cubic Béziers within the given square.
+	"""
+
+	def point():
+		return f"{x + rng.random() * size:.3f},{y + rng.random() * size:.3f}"
+
+	segments = [f"M {point()}"]
+	for _ in range(complexity):
+		segments.append(f"C {point()} {point()} {point()}")
+	segments.append('Z')
+
+	return ' '.join(segments)
+
+
+def make_sheet(source_file, icon_names, sizes, complexity=20, hires=True, seed=0):
+	"""
+	Write a synthetic source SVG to ``source_file``, with a baseplate layer and artwork for each icon.
+
+	:param icon_names: The names of the icons on the sheet.
+	:param sizes: The sizes of the rects on each baseplate, e.g. ``[16, 24, 32, 48, 256]``.
+	:param complexity: The number of curves in each path of the artwork.
+	:param hires: Whether to give each icon a ``hires`` layer for the largest size.
+	"""
+
+	rng = random.Random(seed)
+	nsmap = {None: SVG, "inkscape": INKSCAPE, "sodipodi": SODIPODI}
+
+	column_width = sum(sizes) + 20 * (len(sizes) + 1)
+	row_height = max(sizes) + 60
+
+	root = etree.Element(
+			f"{{{SVG}}}svg",
+			nsmap=nsmap,
+			width=str(column_width),
+			height=str(row_height * len(icon_names)),
+			version="1.1",
+			)
+
+	defs = etree.SubElement(root, f"{{{SVG}}}defs", id="defs")
+	gradient = etree.SubElement(defs, f"{{{SVG}}}linearGradient", id="gradient")
+	etree.SubElement(gradient, f"{{{SVG}}}stop", offset='0', style="stop-color:#729fcf")
+	etree.SubElement(gradient, f"{{{SVG}}}stop", offset='1', style="stop-color:#204a87")
+
+	def layer(parent, label, layer_id):
+		return etree.SubElement(
+				parent,
+				f"{{{SVG}}}g",
+				{f"{{{INKSCAPE}}}groupmode": "layer", f"{{{INKSCAPE}}}label": label},
+				id=layer_id,
+				)
+
+	for number, icon_name in enumerate(icon_names):
+		y = row_height * number + 40
+		baseplate = layer(root, "baseplate", f"baseplate-{number}")
+		baseplate.set("style", "display:none")
+
+		for label, text in [("context", rng.choice(CONTEXTS)), ("icon-name", icon_name)]:
+			element = etree.SubElement(
+					baseplate,
+					f"{{{SVG}}}text",
+					{f"{{{INKSCAPE}}}label": label},
+					id=f"{label}-{number}",
+					x="20" if label == "context" else "160",
+					y=str(y - 20),
+					)
+			tspan = etree.SubElement(element, f"{{{SVG}}}tspan", {f"{{{SODIPODI}}}role": "line"})
+			tspan.text = text
+
+		artwork = layer(root, icon_name, f"artwork-{number}")
+		x = 20
+
+		for size in sizes:
+			etree.SubElement(
+					baseplate,
+					f"{{{SVG}}}rect",
+					{f"{{{INKSCAPE}}}label": f"{size}x{size}"},
+					id=f"rect-{number}-{size}",
+					x=str(x),
+					y=str(y),
+					width=str(size),
+					height=str(size),
+					style="fill:#eeeeec",
+					)
+
+			if hires and size == max(sizes):
+				parent = layer(artwork, "hires", f"hires-{number}")
+			else:
+				parent = artwork
+
+			for path_number in range(3):
+				etree.SubElement(
+						parent,
+						f"{{{SVG}}}path",
+						id=f"path-{number}-{size}-{path_number}",
+						d=make_path(rng, x, y, size, complexity),
+						style="fill:url(#gradient);stroke:#2e3436;stroke-width:1",
+						)
+
+			x += size + 20
+
+	etree.ElementTree(root).write(str(source_file), xml_declaration=True, encoding="UTF-8", pretty_print=True)
+
+
+def make_sources(source_dir, icons, icons_per_sheet, sizes, complexity=20, hires=True, seed=0):
+	"""
+	Write ``icons`` synthetic icons to source SVGs in ``source_dir``, ``icons_per_sheet`` to each.
+
+	:return: The paths of the source SVGs.
+	"""
+
+	source_dir = pathlib.Path(source_dir)
+	source_dir.mkdir(parents=True, exist_ok=True)
+	icon_names = [f"benchmark-icon-{number}" for number in range(icons)]
+	source_files = []
+
+	for sheet, start in enumerate(range(0, icons, icons_per_sheet)):
+		source_file = source_dir / f"benchmark-sheet-{sheet}.svg"
+		make_sheet(source_file, icon_names[start:start + icons_per_sheet], sizes, complexity, hires, seed + sheet)
+		source_files.append(source_file)
+
+	return source_files
+
+
+def get_peak_rss():
+	"""
+	Returns the peak resident set size of this process and of its largest finished child process, in MiB.
+	"""
+
+	# ru_maxrss is in kilobytes on Linux and bytes on macOS
+	scale = 1024 * 1024 if sys.platform == "darwin" else 1024
+
+	return (
+			resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / scale,
+			resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / scale,
+			)
+
+
+def run_once(config):
+	"""
+	Build the icons in ``config["source_dir"]`` once, in this process, and return the measurements.
+	"""
+
+	with tempfile.TemporaryDirectory() as tmp_dir:
+		output_dir = os.path.join(tmp_dir, "output")
+		profile_file = os.path.join(tmp_dir, "profile.json")
+		scalable_directories = [f"{size}/{context}" for size in config["scalable"] for context in CONTEXTS]
+
+		# main() reads the command line, which is this script's
+		sys.argv = sys.argv[:1]
+
+		start = time.perf_counter()
+		gnome_icon_builder.main(
+				config["source_dir"],
+				config["dpis"],
+				output_dir,
+				scalable_directories,
+				workers=config["workers"],
+				use_cache=False,
+				backend=config["backend"],
+				png_effort=config["png_effort"],
+				profile_file=profile_file,
+				)
+		wall_time = time.perf_counter() - start
+
+		icons = sum(len([name for name in files if name != "__init__.py"]) for _, _, files in os.walk(output_dir))
+
+		with open(profile_file) as fp:
+			stages = json.loads(fp.readline())["stages"]
+
+	peak_rss, peak_child_rss = get_peak_rss()
+
+	return {
+			"wall_time": wall_time,
+			"icons": icons,
+			"icons_per_second": icons / wall_time if wall_time else 0,
+			"peak_rss_mib": peak_rss,
+			"peak_child_rss_mib": peak_child_rss,
+			"stages": stages,
+			}
+
+
+def run_in_subprocess(config):
+	"""
+	Run :func:`run_once` in a new Python process, so its memory use and caches are independent of other runs.
+	"""
+
+	process = subprocess.run(
+			[sys.executable, __file__, "--run-once", json.dumps(config)],
+			stdout=subprocess.PIPE,
+			universal_newlines=True,
+			check=True,
+			)
+
+	# The build's progress output comes first
+	return json.loads(process.stdout.strip().splitlines()[-1])
+
+
+def summarise(runs):
+	"""
+	Returns the median and range of each measurement over several runs of the same configuration.
+	"""
+
+	summary = {}
+
+	for measurement in ["wall_time", "icons_per_second", "peak_rss_mib", "peak_child_rss_mib"]:
+		values = [run[measurement] for run in runs]
+		summary[measurement] = {"median": statistics.median(values), "min": min(values), "max": max(values)}
+
+	stages = {}
+	for run in runs:
+		for stage, totals in run["stages"].items():
+			stages.setdefault(stage, []).append(totals["wall_time"])
+
+	summary["stage_wall_time"] = {stage: statistics.median(times) for stage, times in stages.items()}
+
+	return summary
+
+
+def parse_args(argv=None):
+	parser = argparse.ArgumentParser(description="Benchmark building icon themes with gnome_icon_builder.")
+	parser.add_argument("--icons", type=int, default=20, help="The number of synthetic icons (default 20).")
+	parser.add_argument(
+			"--icons-per-sheet", type=int, default=10, help="The number of icons in each source SVG (default 10)."
+			)
+	parser.add_argument(
+			"--sizes",
+			type=int,
+			nargs='+',
+			default=[16, 22, 24, 32, 48, 256],
+			help="The sizes of the icons (default 16 22 24 32 48 256).",
+			)
+	parser.add_argument(
+			"--scalable",
+			nargs='*',
+			default=["256x256"],
+			help="The sizes to produce SVGs for rather than PNGs (default 256x256).",
+			)
+	parser.add_argument("--dpis", type=int, nargs='+', default=[1, 2], help="The DPI multipliers (default 1 2).")
+	parser.add_argument(
+			"--complexity",
+			type=int,
+			default=20,
+			help="The number of curves in each path of the artwork (default 20).",
+			)
+	parser.add_argument("--no-hires", action="store_true", help="Don't give the icons hires layers.")
+	parser.add_argument(
+			"--backends",
+			nargs='+',
+			default=["inkscape"],
+			choices=sorted(gnome_icon_builder.BACKENDS),
+			help="The backends to benchmark (default inkscape).",
+			)
+	parser.add_argument(
+			"--workers", type=int, nargs='+', default=[1], help="The numbers of workers to benchmark (default 1)."
+			)
+	parser.add_argument(
+			"--png-effort",
+			default="fast",
+			choices=sorted(gnome_icon_builder.PNG_EFFORT_LEVELS),
+			help="How hard to optimise PNGs (default fast).",
+			)
+	parser.add_argument(
+			"--repeat", type=int, default=3, help="The number of runs of each configuration (default 3)."
+			)
+	parser.add_argument("--seed", type=int, default=0, help="The seed for generating the artwork (default 0).")
+	parser.add_argument("--output", metavar="FILE", help="Write the results to FILE as JSON.")
+	parser.add_argument("--run-once", metavar="CONFIG", help=argparse.SUPPRESS)
+	return parser.parse_args(argv)
+
+
+def main(argv=None):
+	args = parse_args(argv)
+
+	if args.run_once:
+		print(json.dumps(run_once(json.loads(args.run_once))))
+		return
+
+	results = {
+			"settings": {key: value for key, value in vars(args).items() if key not in {"output", "run_once"}},
+			"python": platform.python_version(),
+			"platform": platform.platform(),
+			"tools": gnome_icon_builder.get_tool_versions(),
+			"results": [],
+			}
+
+	with tempfile.TemporaryDirectory() as source_dir:
+		make_sources(
+				source_dir,
+				args.icons,
+				args.icons_per_sheet,
+				args.sizes,
+				args.complexity,
+				not args.no_hires,
+				args.seed,
+				)
+
+		for backend in args.backends:
+			for workers in args.workers:
+				config = {
+						"source_dir": source_dir,
+						"dpis": args.dpis,
+						"scalable": args.scalable,
+						"backend": backend,
+						"workers": workers,
+						"png_effort": args.png_effort,
+						}
+
+				runs = []
+				for run in range(args.repeat):
+					print(f"{backend}, {workers} workers: run {run + 1} of {args.repeat}", file=sys.stderr)
+					runs.append(run_in_subprocess(config))
+
+				summary = summarise(runs)
+				results["results"].append({
+						"backend": backend,
+						"workers": workers,
+						"runs": runs,
+						"summary": summary,
+						})
+
+				print(
+						f"{backend:<10} {workers:>3} workers  "
+						f"{summary['icons_per_second']['median']:>8.2f} icons/s  "
+						f"{summary['wall_time']['median']:>8.2f}s  "
+						f"peak RSS {summary['peak_rss_mib']['median']:.1f} MiB "
+						f"(largest child {summary['peak_child_rss_mib']['median']:.1f} MiB)"
+						)
+
+				for stage, wall_time in summary["stage_wall_time"].items():
+					print(f"    {stage:<20} {wall_time:>8.2f}s")
+
+	if args.output:
+		with open(args.output, 'w') as fp:
+			json.dump(results, fp, indent=2)
+
+
+if __name__ == "__main__":
+	main()
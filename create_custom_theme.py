@@ -245,13 +245,20 @@ sys.path.append("..")
 				f'''
 
 # this package
-from gnome_icon_builder import get_scalable_directories, main
+from gnome_icon_builder import get_scalable_directories, get_theme_directories, main
 from {package_name} import theme_index_path
 
 scalable_directories = get_scalable_directories(theme_index_path)
+theme_directories = get_theme_directories(theme_index_path)
 output_dir = "./{package_name}/{THEME_NAME}"
 dpis = {str(SVG_FROM_SRC_DPIS)}  # DPI multipliers to render at
-main(os.path.join('.', 'svg_src'), dpis, output_dir, scalable_directories)
+main(
+		os.path.join('.', 'svg_src'),
+		dpis,
+		output_dir,
+		scalable_directories,
+		theme_directories=theme_directories,
+		)
 '''
 				)
 
@@ -7,7 +7,7 @@ Don't call this directly. Instead, use it in your build script.
 
 e.g.
 >>> import os
->>> from gnome_icon_builder import main, get_scalable_directories
+>>> from gnome_icon_builder import InkscapePool, main, get_scalable_directories
 >>> from wx_icons_suru import theme_index_path
 >>>
 >>> SOURCES = ('actions', 'apps', 'categories')
@@ -18,8 +18,19 @@ e.g.
 >>>
 >>> scalable_directories = get_scalable_directories(theme_index_path)
 >>>
->>> for source in SOURCES:
-... 	main(os.path.join('.', 'svg_src', source), dpis, output_dir, scalable_directories)
+>>> # Reuse the same Inkscape processes for every source directory,
+>>> # with one for each of the icons main() renders at once.
+>>> workers = os.cpu_count()
+>>> with InkscapePool(workers) as pool:
+... 	for source in SOURCES:
+... 		main(
+... 				os.path.join('.', 'svg_src', source),
+... 				dpis,
+... 				output_dir,
+... 				scalable_directories,
+... 				inkscape_pool=pool,
+... 				workers=workers,
+... 				)
 >>>
 """
 #
@@ -49,13 +60,33 @@ e.g.
 #
 
 # stdlib
+import argparse
+import collections
+import concurrent.futures
 import configparser
+import contextlib
+import copy
+import csv
+import ctypes
+import ctypes.util
+import functools
+import hashlib
+import itertools
+import json
+import math
 import os
 import pathlib
+import queue
+import re
+import select
+import shutil
+import struct
 import subprocess
 import sys
 import tempfile
-import xml.sax
+import threading
+import time
+import zlib
 
 # 3rd party
 from lxml import etree
@@ -63,6 +94,41 @@ from scour import scour
 
 OPTIPNG = "/usr/bin/optipng"
 
+# The optipng options for each level of PNG optimisation.
+PNG_EFFORT_LEVELS = {
+		"none": None,
+		"fast": ["-o1"],
+		"release": ["-o7"],
+		}
+
+# The longest to wait for Inkscape to respond to a command, in seconds.
+INKSCAPE_TIMEOUT = 300
+
+# Icons no bigger than this are usually hinted to line up with the pixel grid, so are always rendered.
+DOWNSAMPLE_HINTED_SIZE = 32
+
+# The most PNGs to export from one source SVG each time Inkscape loads it.
+INKSCAPE_BATCH_SIZE = 50
+
+# The most items that may be waiting for each worker of a stage of the build
+# before the previous stage has to wait for it to catch up.
+PIPELINE_QUEUE_SIZE = 4
+
+# Printed by Inkscape when it crashes.
+INKSCAPE_CRASH_BANNER = b"Emergency save activated!"
+
+# How long to wait for more changes to the source SVGs before rebuilding in watch mode, in seconds.
+WATCH_SETTLE_TIME = 0.2
+
+# inotify(7) event masks
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_DELETE = 0x00000200
+
+# Increment to invalidate existing build caches when the output format changes.
+CACHE_VERSION = 2
+
 
 class ScourOptions:
 	strip_xml_prolog = False
@@ -81,6 +147,7 @@ class ScourOptions:
 
 INKSCAPE = "http://www.inkscape.org/namespaces/inkscape"
 SVG = "http://www.w3.org/2000/svg"
+XLINK = "http://www.w3.org/1999/xlink"
 
 
 def get_scalable_directories(theme_index_path):
@@ -99,375 +166,3900 @@ def get_scalable_directories(theme_index_path):
 	return scalable_directories
 
 
-def optimize_png(png_file):
-	if os.path.exists(OPTIPNG):
-		process = subprocess.Popen([OPTIPNG, "-quiet", "-o7", png_file])
-		process.wait()
+def get_theme_directories(theme_index_path):
+	"""
+	Returns the names of all the directories of the icon theme, e.g. ``"16x16/apps"`` or ``"16x16@2x/apps"``.
+	"""
 
+	parser = configparser.ConfigParser()
+	parser.read(theme_index_path)
 
-def wait_for_prompt(process, command=None):
-	if command is not None:
-		process.stdin.write((command + '\n').encode("utf-8"))
+	directories = parser.get("Icon Theme", "Directories").split(',')
+	directories += parser.get("Icon Theme", "ScaledDirectories", fallback='').split(',')
 
-	# This is kinda ugly ...
-	# Wait for just a '>', or '\n>' if some other char appeared first
-	output = process.stdout.read(1)
-	if output == b'>':
-		return
-	elif output == b"Emergency save activated!":
-		raise OSError("Something went wrong")
+	return [directory.strip() for directory in directories if directory.strip()]
 
-	output += process.stdout.read(1)
-	while output != b'\n>':
-		output += process.stdout.read(1)
-		output = output[1:]
-		if output == b"Emergency save activated!":
-			raise OSError("Something went wrong")
 
+def default_cache_dir():
+	cache_home = os.environ.get("XDG_CACHE_HOME") or os.path.join(os.path.expanduser('~'), ".cache")
+	return os.path.join(cache_home, "custom_wx_icons")
 
-def get_layer_ids_by_name(input_file, layer_name):
-	tree = etree.parse(str(input_file))
 
-	# Find all layers
-	all_layers = tree.findall(
-			'.//svg:g[@inkscape:groupmode="layer"]', namespaces={"svg": SVG, "inkscape": INKSCAPE}
-			)
+def default_scratch_dir():
+	"""
+	Returns ``/dev/shm`` if it is available, so scratch files are kept in memory, or else the temporary directory.
+	"""
 
-	layer_ids = []
+	if os.path.isdir("/dev/shm") and os.access("/dev/shm", os.W_OK):
+		return "/dev/shm"
 
-	for layer in all_layers:
-		layer_label = layer.get(f"{{{INKSCAPE}}}label")
-		if layer_label:
-			if layer_label.startswith(layer_name):
-				layer_id = layer.get("id")
-				if layer_id:
-					layer_ids.append(layer_id)
+	return tempfile.gettempdir()
 
-	return layer_ids
 
+@functools.lru_cache()
+def get_tool_versions():
+	"""
+	Returns the versions of the tools used to produce icons, for use in cache keys.
+	"""
 
-def check_id_in_svg(input_file, id):
-	tree = etree.parse(str(input_file))
-	results = tree.findall(f".//svg:g[@id=\"{id}\"]", namespaces={"svg": SVG})
-	return bool(len(results))
+	versions = {"scour": scour.__version__}
 
+	for tool, command in [("inkscape", ["inkscape", "--version"]), ("optipng", [OPTIPNG, "-v"])]:
+		try:
+			with _process_start_lock:
+				process = subprocess.run(
+						command,
+						stdin=subprocess.DEVNULL,
+						stdout=subprocess.PIPE,
+						stderr=subprocess.DEVNULL,
+						)
+		except OSError:
+			versions[tool] = None
+		else:
+			output = process.stdout.decode("utf-8", "replace").strip()
+			versions[tool] = output.splitlines()[0] if output else None
 
-def minify_svg(input_file, output_file):
-	# Read SVG file
-	svg_string = pathlib.Path(input_file).read_text()
+	return versions
 
-	# use scour to remove redundant stuff and then write to file
-	svg_string = scour.scourString(svg_string, ScourOptions())
 
-	with open(output_file, 'w') as fp:
-		fp.write(svg_string)
+@functools.lru_cache()
+def get_cairosvg_version():
+	"""
+	Returns the versions of CairoSVG and the cairo library it uses, for use in cache keys,
+	or :py:obj:`None` if CairoSVG can't be loaded.
+	"""
 
+	try:
+		# 3rd party
+		import cairocffi
+		import cairosvg
+	except (ImportError, OSError):
+		return None
 
-class IconBuilder:
+	return f"{cairosvg.__version__} (cairo {cairocffi.cairo_version_string()})"
 
-	def __init__(self, infile, outfile, icon_name, dpi, id, scalable):
-		self.inkscape_process = None
 
-		if scalable:
-			self.make_svg_from_source(infile, outfile, icon_name, dpi, id)
+def get_inkscape_version():
+	"""
+	Returns the version of Inkscape as a tuple of integers, or ``(0, )`` if it isn't installed.
+	"""
+
+	match = re.search(r"Inkscape (\d+)\.(\d+)", get_tool_versions()["inkscape"] or '')
+	if match is None:
+		return (0, )
+
+	return tuple(int(part) for part in match.groups())
+
+
+def get_scour_options():
+	return {name: value for name, value in vars(ScourOptions).items() if not name.startswith('_')}
+
+
+PNG_SIGNATURE = b"\x89PNG\r\n\x1a\n"
+
+# Chunks which affect how the image looks, and so are kept by the builtin PNG optimiser.
+PNG_KEEP_CHUNKS = {b"IHDR", b"PLTE", b"tRNS", b"gAMA", b"cHRM", b"sRGB", b"iCCP", b"sBIT"}
+
+# The number of channels for each PNG colour type.
+PNG_CHANNELS = {0: 1, 2: 3, 3: 1, 4: 2, 6: 4}
+
+# The zlib strategies tried by the builtin PNG optimiser for "release" builds.
+PNG_ZLIB_STRATEGIES = [zlib.Z_DEFAULT_STRATEGY, zlib.Z_FILTERED, getattr(zlib, "Z_RLE", 3)]
+
+# Maps each byte of a filtered scanline to its magnitude as a signed byte, for choosing filters.
+_FILTER_COST = bytes(min(value, 256 - value) for value in range(256))
+
+
+def read_png_chunks(data):
+	"""
+	Returns a list of ``(type, data)`` for the chunks in the PNG file ``data``.
+	"""
+
+	if not data.startswith(PNG_SIGNATURE):
+		raise ValueError("Not a PNG file")
+
+	chunks = []
+	position = len(PNG_SIGNATURE)
+
+	while position < len(data):
+		length, chunk_type = struct.unpack(">I4s", data[position:position + 8])
+		chunks.append((chunk_type, data[position + 8:position + 8 + length]))
+		position += length + 12
+
+		if chunk_type == b"IEND":
+			break
+
+	return chunks
+
+
+def make_png_chunk(chunk_type, data):
+	crc = zlib.crc32(chunk_type + data) & 0xffffffff
+	return struct.pack(">I", len(data)) + chunk_type + data + struct.pack(">I", crc)
+
+
+def _paeth(left, up, up_left):
+	estimate = left + up - up_left
+	distance_left = abs(estimate - left)
+	distance_up = abs(estimate - up)
+	distance_up_left = abs(estimate - up_left)
+
+	if distance_left <= distance_up and distance_left <= distance_up_left:
+		return left
+	elif distance_up <= distance_up_left:
+		return up
+	else:
+		return up_left
+
+
+def unfilter_scanlines(raw, height, stride, bpp):
+	"""
+	Reverse the PNG filters on the decompressed image data ``raw``, returning the scanlines.
+	"""
+
+	rows = []
+	prior = bytearray(stride)
+	position = 0
+
+	for _ in range(height):
+		filter_type = raw[position]
+		line = bytearray(raw[position + 1:position + 1 + stride])
+		position += stride + 1
+
+		if filter_type == 1:
+			for i in range(bpp, stride):
+				line[i] = (line[i] + line[i - bpp]) & 0xff
+		elif filter_type == 2:
+			for i in range(stride):
+				line[i] = (line[i] + prior[i]) & 0xff
+		elif filter_type == 3:
+			for i in range(stride):
+				left = line[i - bpp] if i >= bpp else 0
+				line[i] = (line[i] + ((left + prior[i]) >> 1)) & 0xff
+		elif filter_type == 4:
+			for i in range(stride):
+				if i >= bpp:
+					line[i] = (line[i] + _paeth(line[i - bpp], prior[i], prior[i - bpp])) & 0xff
+				else:
+					line[i] = (line[i] + prior[i]) & 0xff
+		elif filter_type != 0:
+			raise ValueError(f"Unknown PNG filter type {filter_type}")
+
+		rows.append(bytes(line))
+		prior = line
+
+	return rows
+
+
+def filter_scanline(filter_type, line, prior, bpp):
+	left = bytes(bpp) + line[:-bpp]
+
+	if filter_type == 0:
+		return line
+	elif filter_type == 1:
+		return bytes((x - a) & 0xff for x, a in zip(line, left))
+	elif filter_type == 2:
+		return bytes((x - b) & 0xff for x, b in zip(line, prior))
+	elif filter_type == 3:
+		return bytes((x - ((a + b) >> 1)) & 0xff for x, a, b in zip(line, left, prior))
+	else:
+		up_left = bytes(bpp) + prior[:-bpp]
+		return bytes((x - _paeth(a, b, c)) & 0xff for x, a, b, c in zip(line, left, prior, up_left))
+
+
+def filter_scanlines(rows, bpp, adaptive=True):
+	"""
+	Filter the scanlines of an image ready for compression.
+
+	:param adaptive: Whether to choose the filter for each scanline with the minimum sum of absolute differences
+		heuristic. Otherwise no filtering is done.
+	"""
+
+	output = bytearray()
+	prior = bytes(len(rows[0])) if rows else b''
+
+	for line in rows:
+		if adaptive:
+			candidates = [filter_scanline(filter_type, line, prior, bpp) for filter_type in range(5)]
+			costs = [sum(candidate.translate(_FILTER_COST)) for candidate in candidates]
+			filter_type = costs.index(min(costs))
+			output.append(filter_type)
+			output += candidates[filter_type]
 		else:
-			self.inkscape_render_rect(infile, id, dpi, outfile)
-		sys.stdout.write('.')
+			output.append(0)
+			output += line
+		prior = line
 
-	@staticmethod
-	def start_inkscape():
-		process = subprocess.Popen(["inkscape", "--shell"],
-									bufsize=0,
-									stdin=subprocess.PIPE,
-									stdout=subprocess.PIPE)
-		wait_for_prompt(process)
-		return process
+	return bytes(output)
 
-	def inkscape_render_rect(self, icon_file, rect, dpi, output_file):
-		if self.inkscape_process is None:
-			self.inkscape_process = self.start_inkscape()
 
-		cmd = [
-				icon_file,
-				"--export-dpi",
-				str(dpi),
-				"-i",
-				rect,
-				"-e",
-				output_file,
-				]
+def pack_indices(indices, bit_depth):
+	if bit_depth == 8:
+		return bytes(indices)
 
-		wait_for_prompt(self.inkscape_process, ' '.join(cmd))
-		optimize_png(output_file)
+	per_byte = 8 // bit_depth
+	packed = bytearray()
 
-	def inkscape_export_svg(self, icon_file, rect, dpi, output_file):
-		if self.inkscape_process is None:
-			self.inkscape_process = self.start_inkscape()
-		print(rect, icon_file)
+	for start in range(0, len(indices), per_byte):
+		value = 0
+		group = indices[start:start + per_byte]
+		for index in group:
+			value = (value << bit_depth) | index
+		packed.append(value << (bit_depth * (per_byte - len(group))))
 
-		cmd = [
-				str(icon_file),  # '--export-dpi', str(dpi),
-				"-i",
-				rect,
-				"-l",
-				str(output_file),
-				]
+	return bytes(packed)
 
-		wait_for_prompt(self.inkscape_process, ' '.join(cmd))
 
-	def select_layer(self, input_file, tmp_file, icon_name):
-		if self.inkscape_process is None:
-			self.inkscape_process = self.start_inkscape()
+def reduce_png_colours(rows, width, colour_type):
+	"""
+	Reduce an 8-bit greyscale-alpha, RGB or RGBA image to a palette if it has no more than 256 colours,
+	or drop the alpha channel if it is fully opaque.
+
+	:return: ``(rows, colour_type, bit_depth, palette, transparency)``, or :py:obj:`None` if the image can't be reduced.
+	"""
 
-		# Read SVG file
-		icon_layer_ids = get_layer_ids_by_name(input_file, icon_name)
+	channels = PNG_CHANNELS[colour_type]
+	pixel_rows = [[row[i:i + channels] for i in range(0, width * channels, channels)] for row in rows]
+	colours = {pixel for pixel_row in pixel_rows for pixel in pixel_row}
 
-		print(icon_layer_ids)
+	if len(colours) <= 256:
+		if colour_type == 4:
+			rgba = {colour: bytes((colour[0], colour[0], colour[0], colour[1])) for colour in colours}
+		elif colour_type == 2:
+			rgba = {colour: colour + b"\xff" for colour in colours}
+		else:
+			rgba = {colour: colour for colour in colours}
 
-		# Double check that there isn't an exact match for the layer:
-		tree = etree.parse(str(input_file))
+		# Put transparent colours first so the tRNS chunk is as short as possible.
+		ordered = sorted(colours, key=lambda colour: (rgba[colour][3] == 255, rgba[colour]))
+		lookup = {colour: index for index, colour in enumerate(ordered)}
 
-		for layer_id in icon_layer_ids:
-			layer = tree.findall(f".//svg:g[@id=\"{layer_id}\"]", namespaces={"svg": SVG})[0]
-			if layer.get(f"{{{INKSCAPE}}}label") == icon_name:
-				icon_layer_ids = [layer_id]
+		bit_depth = 8
+		for depth in (1, 2, 4):
+			if len(ordered) <= 2**depth:
+				bit_depth = depth
 				break
 
-		print(icon_layer_ids)
-		print('\n')
+		palette = b''.join(rgba[colour][:3] for colour in ordered)
+		transparency = bytes(rgba[colour][3] for colour in ordered if rgba[colour][3] != 255)
+		new_rows = [pack_indices([lookup[pixel] for pixel in pixel_row], bit_depth) for pixel_row in pixel_rows]
 
-		# Get layer ids for hires layers, as we'll need them later
-		hires_layer_ids = get_layer_ids_by_name(input_file, "hires")
+		return new_rows, 3, bit_depth, palette, transparency
 
-		if icon_layer_ids:
-			if icon_layer_ids[0]:
+	if colour_type in {4, 6} and all(row[channels - 1::channels] == b"\xff" * width for row in rows):
+		new_rows = [b''.join(pixel[:-1] for pixel in pixel_row) for pixel_row in pixel_rows]
+		return new_rows, colour_type - 4, 8, None, None
 
-				cmd = [
-						str(input_file),  # '--export-dpi', str(dpi), # TODO
-						"--export-id",
-						icon_layer_ids[0],
-						"--export-plain-svg",
-						str(tmp_file),
-						"--export-id-only",
-						]
+	return None
 
-				wait_for_prompt(self.inkscape_process, ' '.join(cmd))
-		#
-		# elif len(hires_layer_ids) == 1:
-		#
-		# 	cmd = [
-		# 			str(input_file),
-		# 			# '--export-dpi', str(dpi), # TODO
-		# 			'--export-id', hires_layer_ids[0],
-		# 			'--export-plain-svg', str(tmp_file),
-		# 			"--export-id-only"
-		# 			]
-		#
-		# 	wait_for_prompt(inkscape_process, ' '.join(cmd))
-
-		return hires_layer_ids
-
-	def select_only_hires(self, input_file, tmp_file, hires_layer_ids):
-		for layer_id in hires_layer_ids:
-			if check_id_in_svg(input_file, layer_id):
-
-				if self.inkscape_process is None:
-					self.inkscape_process = self.start_inkscape()
-
-				cmd = [
-						str(input_file),  # '--export-dpi', str(dpi), # TODO
-						"--export-id",
-						layer_id,
-						"--export-plain-svg",
-						str(tmp_file),
-						"--export-id-only",
-						"--export-area-page",
-						]
 
-				wait_for_prompt(self.inkscape_process, ' '.join(cmd))
+def optimize_png_data(data, effort="release"):
+	"""
+	Optimise a PNG file without any external tools.
 
-				return 1
+	Non-essential chunks are stripped, images with few enough colours are converted to a palette,
+	each scanline is filtered with the most suitable filter, and the image data is recompressed
+	with the best of several zlib strategies (for the ``"release"`` effort).
 
-		return 0
+	:return: The optimised PNG, or ``data`` if it couldn't be made smaller.
+	"""
 
-	def make_svg_from_source(self, input_file, output_file, icon_name, dpi, id):
-		with tempfile.TemporaryDirectory() as tmp_dir:
-			tmp_dir = pathlib.Path(tmp_dir)
+	if PNG_EFFORT_LEVELS[effort] is None:
+		return data
 
-			tmp_svg = tmp_dir / f"{icon_name}.svg"
+	chunks = read_png_chunks(data)
+	header = chunks[0][1]
+	width, height, bit_depth, colour_type, compression, filter_method, interlace = struct.unpack(">IIBBBBB", header)
 
-			hires_layer_ids = self.select_layer(input_file, tmp_svg, icon_name)
-			if not tmp_svg.exists():
-				# Wasn't a multi-image svg
-				self.inkscape_export_svg(input_file, id, dpi, tmp_svg)
-			else:
-				self.inkscape_export_svg(tmp_svg, id, dpi, tmp_svg)
-			print(253, tmp_svg)
-			self.select_only_hires(tmp_svg, tmp_svg, hires_layer_ids)
-			print(255, tmp_svg)
-			minify_svg(tmp_svg, output_file)
+	image_data = zlib.decompress(b''.join(chunk_data for chunk_type, chunk_data in chunks if chunk_type == b"IDAT"))
+	kept_chunks = [(chunk_type, chunk_data) for chunk_type, chunk_data in chunks if chunk_type in PNG_KEEP_CHUNKS]
 
-	def render_icon(self, infile, outfile, icon_name, dpi, id, scalable):
-		if scalable:
-			self.make_svg_from_source(infile, outfile, icon_name, dpi, id)
-		else:
-			self.inkscape_render_rect(infile, id, dpi, outfile)
-		sys.stdout.write('.')
-
-
-def main(source_dir, dpis, output_dir, scalable_directories):
-
-	class ContentHandler(xml.sax.ContentHandler):
-		ROOT = 0
-		SVG = 1
-		LAYER = 2
-		OTHER = 3
-		TEXT = 4
-
-		def __init__(self, path, force=False, filter=None):
-			self.stack = [self.ROOT]
-			self.inside = [self.ROOT]
-			self.path = path
-			self.rects = []
-			self.state = self.ROOT
-			self.chars = ''
-			self.force = force
-			self.filter = filter
-
-		def endDocument(self):
-			pass
+	candidates = []
+
+	if interlace or colour_type not in PNG_CHANNELS:
+		# Leave the image data as it is and just recompress it.
+		candidates.append(image_data)
+	else:
+		channels = PNG_CHANNELS[colour_type]
+		bpp = max(1, channels * bit_depth // 8)
+		stride = (width * channels * bit_depth + 7) // 8
+		rows = unfilter_scanlines(image_data, height, stride, bpp)
+
+		reduced = None
+		if bit_depth == 8 and colour_type in {2, 4, 6}:
+			reduced = reduce_png_colours(rows, width, colour_type)
+
+		if reduced is not None:
+			original_colour_type = colour_type
+			rows, colour_type, bit_depth, palette, transparency = reduced
+			header = struct.pack(">IIBBBBB", width, height, bit_depth, colour_type, compression, filter_method, 0)
+
+			# Only the chunks that depend on the colour type are rebuilt.
+			# The colour management chunks are kept, in their original order, before the palette.
+			rebuilt_chunks = [(b"IHDR", header)]
+			for chunk_type, chunk_data in kept_chunks:
+				if chunk_type == b"sBIT":
+					# The significant bits of each channel, which for a palette are those of red, green and blue.
+					if original_colour_type == 4:
+						chunk_data = chunk_data[:1] * (3 if colour_type == 3 else 1)
+					else:
+						chunk_data = chunk_data[:3]
+					rebuilt_chunks.append((chunk_type, chunk_data))
+				elif chunk_type not in {b"IHDR", b"PLTE", b"tRNS"}:
+					rebuilt_chunks.append((chunk_type, chunk_data))
+
+			kept_chunks = rebuilt_chunks
+			if palette is not None:
+				kept_chunks.append((b"PLTE", palette))
+			if transparency:
+				kept_chunks.append((b"tRNS", transparency))
+			channels = PNG_CHANNELS[colour_type]
+			bpp = max(1, channels * bit_depth // 8)
+
+		# Filtering rarely helps palette images, but try both ways for release builds.
+		if colour_type != 3 or bit_depth < 8 or effort == "release":
+			candidates.append(filter_scanlines(rows, bpp, adaptive=colour_type != 3))
+		if effort == "release" and colour_type != 3:
+			candidates.append(filter_scanlines(rows, bpp, adaptive=False))
+		if not candidates:
+			candidates.append(filter_scanlines(rows, bpp, adaptive=False))
+
+	strategies = PNG_ZLIB_STRATEGIES if effort == "release" else [zlib.Z_DEFAULT_STRATEGY]
+	compressed = []
+
+	for candidate in candidates:
+		for strategy in strategies:
+			compressor = zlib.compressobj(9, zlib.DEFLATED, 15, 9, strategy)
+			compressed.append(compressor.compress(candidate) + compressor.flush())
+
+	output = PNG_SIGNATURE + b''.join(make_png_chunk(chunk_type, chunk_data) for chunk_type, chunk_data in kept_chunks)
+	output += make_png_chunk(b"IDAT", min(compressed, key=len)) + make_png_chunk(b"IEND", b'')
+
+	return output if len(output) < len(data) else data
+
+
+def read_png_pixels(data):
+	"""
+	Decode a non-interlaced PNG file with 8-bit samples (or a palette) into an RGBA :class:`numpy.ndarray`.
+	"""
+
+	# 3rd party
+	import numpy
+
+	chunks = read_png_chunks(data)
+	width, height, bit_depth, colour_type, compression, filter_method, interlace = struct.unpack(">IIBBBBB", chunks[0][1])
+
+	if interlace or colour_type not in PNG_CHANNELS or (bit_depth != 8 and colour_type != 3):
+		raise ValueError("Unsupported PNG format")
+
+	channels = PNG_CHANNELS[colour_type]
+	stride = (width * channels * bit_depth + 7) // 8
+	image_data = zlib.decompress(b''.join(chunk_data for chunk_type, chunk_data in chunks if chunk_type == b"IDAT"))
+	rows = unfilter_scanlines(image_data, height, stride, max(1, channels * bit_depth // 8))
+	samples = numpy.frombuffer(b''.join(rows), dtype=numpy.uint8).reshape(height, stride)
+
+	if colour_type == 3:
+		chunk_dict = dict(chunks)
+		palette = numpy.frombuffer(chunk_dict[b"PLTE"], dtype=numpy.uint8).reshape(-1, 3)
+		alpha = numpy.full(len(palette), 255, dtype=numpy.uint8)
+		transparency = numpy.frombuffer(chunk_dict.get(b"tRNS", b''), dtype=numpy.uint8)
+		alpha[:len(transparency)] = transparency
+		indices = numpy.unpackbits(samples, axis=1).reshape(height, -1, bit_depth)
+		indices = indices.dot(1 << numpy.arange(bit_depth - 1, -1, -1))[:, :width]
+		return numpy.dstack([palette[indices], alpha[indices]])
+
+	pixels = samples.reshape(height, width, channels)
+	opaque = numpy.full((height, width, 1), 255, dtype=numpy.uint8)
+
+	if colour_type == 0:
+		return numpy.dstack([pixels, pixels, pixels, opaque])
+	elif colour_type == 2:
+		return numpy.dstack([pixels, opaque])
+	elif colour_type == 4:
+		return numpy.dstack([pixels[..., :1], pixels[..., :1], pixels[..., :1], pixels[..., 1:]])
+	else:
+		return pixels
 
-		def startElement(self, name, attrs):
-			if self.inside[-1] == self.ROOT:
-				if name == "svg":
-					self.stack.append(self.SVG)
-					self.inside.append(self.SVG)
-					return
-			elif self.inside[-1] == self.SVG:
-				if (
-						name == 'g' and "inkscape:groupmode" in attrs and "inkscape:label" in attrs
-						and attrs["inkscape:groupmode"] == "layer"
-						and attrs["inkscape:label"].lower().startswith("baseplate")
-						):
-					self.stack.append(self.LAYER)
-					self.inside.append(self.LAYER)
-					self.context = None
-					self.icon_name = None
-					self.rects = []
-					return
-			elif self.inside[-1] == self.LAYER:
-				if name == "text" and ("inkscape:label" in attrs) and attrs["inkscape:label"] == "context":
-					self.stack.append(self.TEXT)
-					self.inside.append(self.TEXT)
-					self.text = "context"
-					self.chars = ''
-					return
-				elif name == "text" and ("inkscape:label" in attrs) and attrs["inkscape:label"] == "icon-name":
-					self.stack.append(self.TEXT)
-					self.inside.append(self.TEXT)
-					self.text = "icon-name"
-					self.chars = ''
-					return
-				elif name == "rect":
-					self.rects.append(attrs)
 
-			self.stack.append(self.OTHER)
+def write_png_pixels(png_file, pixels):
+	"""
+	Write an RGBA :class:`numpy.ndarray` to ``png_file``. The PNG isn't optimised.
+	"""
 
-		def endElement(self, name):
-			stacked = self.stack.pop()
+	height, width = pixels.shape[:2]
+	header = struct.pack(">IIBBBBB", width, height, 8, 6, 0, 0, 0)
+	image_data = b''.join(b"\x00" + row.tobytes() for row in pixels)
 
-			if self.inside[-1] == stacked:
-				self.inside.pop()
+	pathlib.Path(png_file).write_bytes(
+			PNG_SIGNATURE + make_png_chunk(b"IHDR", header) + make_png_chunk(b"IDAT", zlib.compress(image_data))
+			+ make_png_chunk(b"IEND", b'')
+			)
 
-			if stacked == self.TEXT and self.text is not None:
-				assert self.text in ["context", "icon-name"]
-				if self.text == "context":
-					self.context = self.chars
-				elif self.text == "icon-name":
-					self.icon_name = self.chars
-				self.text = None
-			elif stacked == self.LAYER:
-				assert self.icon_name
-				assert self.context
 
-				if self.filter is not None and self.icon_name not in self.filter:
-					return
+def downsample_png(input_file, output_file, factor):
+	"""
+	Make a copy of ``input_file`` that is ``factor`` times smaller, by averaging each block of pixels.
 
-				print(self.context, self.icon_name)
+	:return: Whether the downsampled icon was written. If not, it should be rendered instead.
+	"""
 
-				# TODO: Check that all sizes are available, and if not use the largest size available for the missing sizes
+	# 3rd party
+	import numpy
 
-				for rect in self.rects:
-					for dpi_factor in dpis:
-						width = int(float(rect["width"]))
-						height = int(float(rect["height"]))
-						id = rect["id"]
-						dpi = 96 * dpi_factor
+	try:
+		pixels = read_png_pixels(pathlib.Path(input_file).read_bytes())
+	except ValueError:
+		return False
 
-						size_str = f"{width}x{height}"
-						if dpi_factor != 1:
-							size_str += "@%sx" % dpi_factor
+	height, width = pixels.shape[:2]
+	if height % factor or width % factor:
+		return False
 
-						directory = os.path.join(output_dir, size_str, self.context)
+	# Average with premultiplied alpha, so fully transparent pixels don't bleed into the edges.
+	image = pixels.astype(numpy.float64)
+	image[..., :3] *= image[..., 3:] / 255
+	blocks = image.reshape(height // factor, factor, width // factor, factor, 4)
+	averaged = blocks.mean(axis=(1, 3))
 
-						scalable = bool(f"{size_str}/{self.context}" in scalable_directories)
+	alpha = averaged[..., 3:]
+	colour = numpy.divide(
+			averaged[..., :3] * 255,
+			alpha,
+			out=numpy.zeros_like(averaged[..., :3]),
+			where=alpha > 0,
+			)
 
-						svg_file = os.path.join(directory, self.icon_name + ".svg")
-						png_file = os.path.join(directory, self.icon_name + ".png")
+	result = numpy.clip(numpy.rint(numpy.dstack([colour, alpha])), 0, 255).astype(numpy.uint8)
+	write_png_pixels(output_file, result)
 
-						if not os.path.exists(directory):
-							os.makedirs(directory)
+	return True
 
-						if scalable:
-							if os.path.isfile(png_file):
-								os.unlink(png_file)
-							outfile = svg_file
-						else:
-							if os.path.isfile(svg_file):
-								os.unlink(svg_file)
-							outfile = png_file
-
-						# Do a time based check!
-						if self.force or not os.path.exists(outfile):
-
-							try:
-								IconBuilder(self.path, outfile, self.icon_name, dpi, id, scalable)
-							except OSError:
-								print(f"Unable to process {self.path}.")
-								continue
-						else:
-							stat_in = os.stat(self.path)
-							stat_out = os.stat(outfile)
-							if stat_in.st_mtime > stat_out.st_mtime:
-								IconBuilder(self.path, outfile, self.icon_name, dpi, id, scalable)
-							else:
-								sys.stdout.write('-')
-						sys.stdout.flush()
-				sys.stdout.write('\n')
-				sys.stdout.flush()
 
-		def characters(self, chars):
-			self.chars += chars.strip()
-
-	if len(sys.argv) == 1:
-		if not os.path.exists(output_dir):
-			os.mkdir(output_dir)
-		open(os.path.join(output_dir, "__init__.py"), 'w').close()
-		print("Rendering from SVGs in", source_dir)
-		for file in os.listdir(source_dir):
-			if file[-4:] == ".svg":
-				file = os.path.join(source_dir, file)
-				handler = ContentHandler(file)
-				xml.sax.parse(open(file), handler)
+def get_png_optimizer():
+	"""
+	Returns the name of the PNG optimiser to use by default:
+	``"optipng"`` if it is installed, otherwise ``"builtin"``.
+	"""
+
+	return "optipng" if os.path.exists(OPTIPNG) else "builtin"
+
+
+def optimize_png(png_file, effort="release", optimizer=None):
+	"""
+	Optimise ``png_file`` in place, with optipng if it is installed or the builtin optimiser if not.
+
+	:param optimizer: ``"optipng"`` or ``"builtin"``, to override the choice of optimiser.
+	"""
+
+	options = PNG_EFFORT_LEVELS[effort]
+	if options is None:
+		return
+
+	if (optimizer or get_png_optimizer()) == "optipng" and os.path.exists(OPTIPNG):
+		with _process_start_lock:
+			process = subprocess.Popen([OPTIPNG, "-quiet", *options, str(png_file)])
+		process.wait()
+	else:
+		png_file = pathlib.Path(png_file)
+		data = png_file.read_bytes()
+		optimized = optimize_png_data(data, effort)
+		if optimized is not data:
+			png_file.write_bytes(optimized)
+
+
+def wait_for_prompt(process, command=None, timeout=None):
+	"""
+	Send ``command`` to an ``inkscape --shell`` process, if given, and wait for the shell's prompt.
+
+	The prompt is looked for on stdout, and the crash banner on stderr if that is a pipe,
+	so warnings written to stderr can't hide the prompt.
+
+	:param timeout: The longest to wait for the prompt, in seconds.
+
+	:raises TimeoutError: If Inkscape didn't respond within ``timeout`` seconds.
+	:raises OSError: If Inkscape crashed or exited.
+
+	:return: The output from Inkscape before the prompt.
+	"""
+
+	if command is not None:
+		process.stdin.write((command + '\n').encode("utf-8"))
+
+	fd = process.stdout.fileno()
+	output = bytearray()
+
+	if process.stderr is not None:
+		error_fd = process.stderr.fileno()
+		fds = [error_fd, fd]
 	else:
-		file = os.path.join(source_dir, sys.argv[1] + ".svg")
-		if len(sys.argv) > 2:
-			icons = sys.argv[2:]
+		error_fd = None
+		fds = [fd]
+
+	# The end of what has been read from stderr, in case the banner was split between reads.
+	errors = b''
+
+	if timeout is not None:
+		deadline = time.monotonic() + timeout
+
+	while True:
+		if os.name == "posix":
+			if timeout is not None:
+				remaining = deadline - time.monotonic()
+				if remaining <= 0:
+					raise TimeoutError(f"Inkscape did not respond within {timeout} seconds")
+			else:
+				remaining = None
+
+			ready = select.select(fds, [], [], remaining)[0]
+			if not ready:
+				raise TimeoutError(f"Inkscape did not respond within {timeout} seconds")
 		else:
-			icons = None
-		if os.path.exists(os.path.join(file)):
-			handler = ContentHandler(file, True, filter=icons)
-			xml.sax.parse(open(file), handler)
+			ready = [fd]
+
+		if error_fd in ready:
+			chunk = os.read(error_fd, 4096)
+			if not chunk:
+				# stderr was closed; carry on waiting for stdout.
+				fds.remove(error_fd)
+				error_fd = None
+			else:
+				errors += chunk
+				if INKSCAPE_CRASH_BANNER in errors:
+					raise OSError("Inkscape crashed")
+				errors = errors[-len(INKSCAPE_CRASH_BANNER):]
+
+		if fd in ready:
+			chunk = os.read(fd, 4096)
+			if not chunk:
+				raise OSError("Inkscape exited unexpectedly")
+
+			output += chunk
+
+			# Wait for just a '>', or '\n>' if some other output appeared first
+			prompt = output.rstrip(b' ')
+			if prompt == b'>' or prompt.endswith(b"\n>"):
+				return bytes(prompt[:-1])
+
+
+def get_layer_ids_by_name(input_file, layer_name):
+	return SourceSheetIndex.for_file(input_file).get_layer_ids_by_name(layer_name)
+
+
+def check_id_in_svg(input_file, id):
+	return SourceSheetIndex.for_file(input_file).has_id(id)
+
+
+_TRANSFORM_RE = re.compile(r"(matrix|translate|scale|rotate|skewX|skewY)\s*\(([^)]*)\)")
+
+
+def multiply_matrices(a, b):
+	return (
+			a[0] * b[0] + a[2] * b[1],
+			a[1] * b[0] + a[3] * b[1],
+			a[0] * b[2] + a[2] * b[3],
+			a[1] * b[2] + a[3] * b[3],
+			a[0] * b[4] + a[2] * b[5] + a[4],
+			a[1] * b[4] + a[3] * b[5] + a[5],
+			)
+
+
+def parse_transform(transform):
+	"""
+	Parse an SVG ``transform`` attribute into an ``(a, b, c, d, e, f)`` matrix.
+	"""
+
+	matrix = (1, 0, 0, 1, 0, 0)
+
+	for name, args in _TRANSFORM_RE.findall(transform or ''):
+		values = [float(value) for value in re.split(r"[\s,]+", args.strip()) if value]
+
+		if name == "matrix":
+			step = tuple(values)
+		elif name == "translate":
+			step = (1, 0, 0, 1, values[0], values[1] if len(values) > 1 else 0)
+		elif name == "scale":
+			step = (values[0], 0, 0, values[1] if len(values) > 1 else values[0], 0, 0)
+		elif name == "rotate":
+			angle = math.radians(values[0])
+			cos, sin = math.cos(angle), math.sin(angle)
+			step = (cos, sin, -sin, cos, 0, 0)
+			if len(values) == 3:
+				centre_x, centre_y = values[1:]
+				step = multiply_matrices((1, 0, 0, 1, centre_x, centre_y), step)
+				step = multiply_matrices(step, (1, 0, 0, 1, -centre_x, -centre_y))
+		elif name == "skewX":
+			step = (1, 0, math.tan(math.radians(values[0])), 1, 0, 0)
 		else:
-			print("Error: No such file", file)
-			sys.exit(1)
+			step = (1, math.tan(math.radians(values[0])), 0, 1, 0, 0)
+
+		matrix = multiply_matrices(matrix, step)
+
+	return matrix
+
+
+def get_rect_bounds(ids, rect_id):
+	"""
+	Returns the ``(x, y, width, height)`` of the rect with the given id in the user space of the document,
+	taking into account the transforms of the rect and the groups it is in.
+
+	:param ids: A mapping of ids to the elements of the document.
+	"""
+
+	rect = ids.get(rect_id)
+	if rect is None:
+		raise ValueError(f"No element with the id {rect_id!r}")
+
+	matrix = (1, 0, 0, 1, 0, 0)
+	for element in reversed([rect, *rect.iterancestors()][:-1]):
+		matrix = multiply_matrices(matrix, parse_transform(element.get("transform")))
+
+	x = float(rect.get('x', 0))
+	y = float(rect.get('y', 0))
+	width = float(rect.get("width"))
+	height = float(rect.get("height"))
+
+	corners = [(x, y), (x + width, y), (x, y + height), (x + width, y + height)]
+	xs = [matrix[0] * cx + matrix[2] * cy + matrix[4] for cx, cy in corners]
+	ys = [matrix[1] * cx + matrix[3] * cy + matrix[5] for cx, cy in corners]
+
+	return min(xs), min(ys), max(xs) - min(xs), max(ys) - min(ys)
+
+
+class HashingReader:
+	"""
+	Wraps a binary file object, and hashes everything read from it with SHA-256.
+	"""
+
+	def __init__(self, fp):
+		self.fp = fp
+		self.sha = hashlib.sha256()
+
+	def read(self, size=-1):
+		data = self.fp.read(size)
+		self.sha.update(data)
+		return data
+
+
+def get_cache_key(
+		icon_digest,
+		rect,
+		dpi,
+		scalable,
+		backend="inkscape",
+		png_effort="release",
+		png_optimizer="optipng",
+		downsample_from=None,
+		):
+	"""
+	Returns the build cache key for rendering ``rect`` of an icon at the given DPI.
+
+	:param icon_digest: The hash of what the icon is rendered from: the source SVG without the layers of
+		the sheet's other icons for a PNG (see :attr:`SourceSheetIndex.png_digests`),
+		or the extracted, unminified SVG for a scalable icon.
+	"""
+
+	tools = dict(get_tool_versions())
+	if backend == "cairosvg":
+		# Inkscape isn't used, but CairoSVG and cairo are.
+		tools["inkscape"] = None
+		tools["cairosvg"] = get_cairosvg_version()
+
+	data = {
+			"version": CACHE_VERSION,
+			"icon": icon_digest,
+			"rect": {attr: rect.get(attr) for attr in ("x", "y", "width", "height", "transform")},
+			"dpi": dpi,
+			"scalable": scalable,
+			"backend": backend,
+			"png_effort": None if scalable else png_effort,
+			"png_optimizer": None if scalable else png_optimizer,
+			"downsample_from": downsample_from,
+			"scour": get_scour_options(),
+			"tools": tools,
+			}
+
+	return hashlib.sha256(json.dumps(data, sort_keys=True).encode("UTF-8")).hexdigest()
+
+
+SourceIcon = collections.namedtuple("SourceIcon", ["source", "context", "icon_name", "rects"])
+
+
+class SourceSheetIndex:
+	"""
+	The layers, ids and baseplates of a source SVG, found by reading through the file once.
+
+	The file is read with :func:`lxml.etree.iterparse`, and each element is cleared once it has been read,
+	so only the element being read and its ancestors are held in memory, however large the file is.
+
+	Use :meth:`for_file` to share the index between all the steps that need it.
+
+	Only the layers, baseplates and digests are pickled, so an index made in another process is cheap to send back.
+	The ids are found again if they are needed.
+	"""
+
+	_cache = collections.OrderedDict()
+	_cache_lock = threading.Lock()
+	_cache_size = 256
+
+	def __init__(self, source_file):
+		self.source_file = str(source_file)
+
+		stat = os.stat(self.source_file)
+
+		#: The modification time and size of the file when it was indexed.
+		self.stat_key = (stat.st_mtime_ns, stat.st_size)
+
+		layers, icons, icon_digests, png_digests, self._ids, file_digest = self._scan()
+
+		#: ``(id, label)`` for each layer, in document order.
+		self.layers = layers
+
+		#: A :class:`SourceIcon` for each baseplate layer.
+		self.icons = icons
+
+		#: Mapping of icon names to a hash of the parts of the document drawn specifically for them.
+		#: That is the layers labelled with the icon name, and the document's ``<defs>``,
+		#: or the whole file if it doesn't have a layer for the icon.
+		#: Used to tell which icons have been edited; PNGs are cached by :attr:`png_digests`, as they include
+		#: everything visible in the area of their rect.
+		self.icon_digests = icon_digests
+
+		#: Mapping of icon names to a hash of everything a PNG of the icon may show: the whole document
+		#: except the layers of the sheet's other icons, so editing one icon doesn't change the others' PNGs.
+		self.png_digests = png_digests
+
+		#: The hash of the whole file.
+		self.file_digest = file_digest
+
+	def _scan(self):
+		"""
+		Read through the file.
+
+		Each layer and ``<defs>`` element is hashed as it is read, from the tags, attributes and text
+		of it and the elements inside it. The document is also hashed in segments, split wherever a layer
+		starts or ends, so the PNG digests can leave out the layers of other icons.
+
+		:return: The layers, icons, icon digests, PNG digests, ids and the hash of the whole file.
+		"""
+
+		svg_tag = f"{{{SVG}}}svg"
+		g_tag = f"{{{SVG}}}g"
+		defs_tag = f"{{{SVG}}}defs"
+		text_tag = f"{{{SVG}}}text"
+		rect_tag = f"{{{SVG}}}rect"
+		groupmode = f"{{{INKSCAPE}}}groupmode"
+		inkscape_label = f"{{{INKSCAPE}}}label"
+
+		layers = []
+		icons = []
+		ids = set()
+
+		# The hashes of the layers, as ``(label, hash)``, and of the <defs>, in document order.
+		layer_hashes = []
+		defs_hashes = []
+
+		# The hash for each open element if it is a layer or <defs>, or None, and those that aren't None.
+		stack = []
+		hashers = []
+
+		# ``(layers, hash)`` for each segment of the document, where ``layers`` are the indexes
+		# in ``layers`` of the layers the segment is in. Tokens go to ``segment`` as well as ``hashers``.
+		open_layers = ()
+		segment = hashlib.sha256()
+		segments = [(open_layers, segment)]
+
+		root = None
+		text_depth = 0
+		baseplate = None
+		baseplate_texts = {}
+		baseplate_rects = []
+
+		# The baseplate's context or icon name <text> being read.
+		label_text = None
+
+		# The last element to end, which is cleared once its tail has been read.
+		finished = None
+
+		with open(self.source_file, "rb") as fp:
+			reader = HashingReader(fp)
+			events = etree.iterparse(
+					reader,
+					events=("start", "end"),
+					remove_comments=True,
+					remove_pis=True,
+					huge_tree=True,
+					)
+
+			for event, element in events:
+				if finished is not None:
+					if finished.tail:
+						token = b"\x03" + finished.tail.encode("UTF-8")
+						segment.update(token)
+						for sha in hashers:
+							sha.update(token)
+
+					# Text is read from the whole <text> element once it ends, so keep what is inside it until then.
+					if not text_depth:
+						finished.clear()
+						while finished.getprevious() is not None:
+							del finished.getparent()[0]
+
+					finished = None
+
+				if event == "start":
+					if root is None:
+						root = element
+
+					element_id = element.get("id")
+					if element_id:
+						ids.add(element_id)
+
+					# Attributes may hold whole embedded images, so avoid copying them more than needed.
+					tokens = [f"\x01{element.tag}".encode("UTF-8")]
+					for name, value in sorted(element.attrib.items()):
+						tokens.append(f"\x02{name}=".encode("UTF-8"))
+						tokens.append(value.encode("UTF-8"))
+
+					sha = None
+
+					if element.tag == g_tag and element.get(groupmode) == "layer":
+						label = element.get(inkscape_label)
+						open_layers += (len(layers), )
+						layers.append((element_id, label))
+						sha = hashlib.sha256()
+						layer_hashes.append((label, sha))
+
+						segment = hashlib.sha256()
+						segments.append((open_layers, segment))
+
+						# Baseplates may be at any depth, but not inside another baseplate.
+						if (
+								baseplate is None and root.tag == svg_tag
+								and (label or '').lower().startswith("baseplate")
+								):
+							baseplate = element
+							baseplate_texts = {}
+							baseplate_rects = []
+
+					elif element.tag == defs_tag:
+						sha = hashlib.sha256()
+						defs_hashes.append(sha)
+
+					elif element.tag == text_tag:
+						text_depth += 1
+
+						if (
+								baseplate is not None and label_text is None
+								and element.get(inkscape_label) in {"context", "icon-name"}
+								):
+							label_text = element
+
+					# Rects in the baseplate count wherever they are, except in its context and icon name.
+					elif element.tag == rect_tag and baseplate is not None and label_text is None:
+						baseplate_rects.append(dict(element.attrib))
+
+					stack.append(sha)
+					if sha is not None:
+						hashers.append(sha)
+
+					for sha in [segment, *hashers]:
+						for token in tokens:
+							sha.update(token)
+
+				else:
+					token = b"\x03" + element.text.encode("UTF-8") + b"\x04" if element.text else b"\x04"
+					segment.update(token)
+					for sha in hashers:
+						sha.update(token)
+
+					if stack.pop() is not None:
+						hashers.pop()
+
+					if element.tag == g_tag and element.get(groupmode) == "layer":
+						open_layers = open_layers[:-1]
+						segment = hashlib.sha256()
+						segments.append((open_layers, segment))
+
+					if element.tag == text_tag:
+						text_depth -= 1
+
+						if element is label_text:
+							# Leading and trailing whitespace is removed from each line, e.g. of a <tspan>.
+							baseplate_texts[element.get(inkscape_label)] = ''.join(
+									line.strip() for text in element.itertext() for line in text.splitlines()
+									)
+							label_text = None
+
+					elif element is baseplate:
+						assert baseplate_texts.get("icon-name")
+						assert baseplate_texts.get("context")
+
+						icons.append(
+								SourceIcon(
+										self.source_file,
+										baseplate_texts["context"],
+										baseplate_texts["icon-name"],
+										baseplate_rects,
+										)
+								)
+						baseplate = None
+
+					finished = element
+
+		file_digest = reader.sha.hexdigest()
+		icon_digests = {}
+		png_digests = {}
+
+		icon_names = {icon.icon_name for icon in icons}
+
+		# The icons each layer belongs to.
+		layer_icons = [{name for name in icon_names if (label or '').startswith(name)} for _, label in layers]
+
+		for icon_name in icon_names:
+			icon_layer_hashes = [sha for label, sha in layer_hashes if (label or '').startswith(icon_name)]
+
+			if icon_layer_hashes:
+				digest = hashlib.sha256()
+				for sha in defs_hashes + icon_layer_hashes:
+					digest.update(sha.digest())
+				icon_digests[icon_name] = digest.hexdigest()
+			else:
+				icon_digests[icon_name] = file_digest
+
+			# The <defs> are always included, as the icon may use them wherever they are.
+			digest = hashlib.sha256()
+			for sha in defs_hashes:
+				digest.update(sha.digest())
+
+			for segment_layers, sha in segments:
+				owners = set().union(*(layer_icons[layer] for layer in segment_layers))
+				if not owners or icon_name in owners:
+					digest.update(b"\x05" + sha.digest())
+				else:
+					# Record where the other icon's layer was without what's in it.
+					digest.update(b"\x06")
+
+			png_digests[icon_name] = digest.hexdigest()
+
+		return layers, icons, icon_digests, png_digests, ids, file_digest
+
+	def __getstate__(self):
+		state = self.__dict__.copy()
+		state["_ids"] = None
+		return state
+
+	@property
+	def ids(self):
+		"""
+		The ids of all the elements in the file.
+		"""
+
+		if self._ids is None:
+			self._ids = self._scan()[4]
+
+		return self._ids
+
+	@classmethod
+	def for_file(cls, source_file):
+		"""
+		Returns the index for ``source_file``, which is reused until the file changes.
+		"""
+
+		stat = os.stat(str(source_file))
+		key = (str(source_file), stat.st_mtime_ns, stat.st_size)
+
+		with cls._cache_lock:
+			index = cls._cache.get(key)
+			if index is not None:
+				cls._cache.move_to_end(key)
+				return index
+
+		index = cls(source_file)
+		cls.add_to_cache(index)
+		return index
+
+	@classmethod
+	def add_to_cache(cls, index):
+		"""
+		Adds ``index`` to the indexes returned by :meth:`for_file`, e.g. one made in another process.
+		"""
+
+		with cls._cache_lock:
+			cls._cache[(index.source_file, *index.stat_key)] = index
+			while len(cls._cache) > cls._cache_size:
+				cls._cache.popitem(last=False)
+
+	def get_layer_ids_by_name(self, layer_name):
+		"""
+		Returns the ids of the layers whose labels start with ``layer_name``.
+		"""
+
+		return [layer_id for layer_id, label in self.layers if layer_id and label and label.startswith(layer_name)]
+
+	def get_icon_layer_ids(self, icon_name):
+		"""
+		Returns the ids of the layers for ``icon_name``, or just the one layer labelled exactly ``icon_name`` if there is one.
+		"""
+
+		for layer_id, label in self.layers:
+			if layer_id and label == icon_name:
+				return [layer_id]
+
+		return self.get_layer_ids_by_name(icon_name)
+
+	def has_id(self, id):
+		return id in self.ids
+
+
+class BuildCache:
+	"""
+	A persistent cache mapping a hash of everything an icon is produced from to the file produced.
+
+	The files themselves are stored once each under ``objects``, named by the hash of their contents.
+	"""
+
+	def __init__(self, cache_dir):
+		self.cache_dir = pathlib.Path(cache_dir)
+		self.objects_dir = self.cache_dir / "objects"
+		self.index_file = self.cache_dir / "index.json"
+		self._lock = threading.Lock()
+
+		try:
+			self.index = json.loads(self.index_file.read_text())
+		except (OSError, ValueError):
+			self.index = {}
+
+		#: How long icons took to render in previous builds.
+		self.costs = CostHistory(self.cache_dir / "costs.json")
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, exc_type, exc_val, exc_tb):
+		self.save()
+
+	def object_path(self, digest):
+		return self.objects_dir / digest[:2] / digest
+
+	def contains(self, key):
+		digest = self.index.get(key)
+		return digest is not None and self.object_path(digest).is_file()
+
+	def restore(self, key, output_file):
+		"""
+		Copy the file cached for ``key`` to ``output_file``.
+
+		:return: Whether there was a file in the cache.
+		"""
+
+		digest = self.index.get(key)
+		if digest is None:
+			return False
+
+		try:
+			shutil.copyfile(str(self.object_path(digest)), str(output_file))
+		except FileNotFoundError:
+			return False
+
+		return True
+
+	def store(self, key, output_file):
+		data = pathlib.Path(output_file).read_bytes()
+		digest = hashlib.sha256(data).hexdigest()
+
+		object_path = self.object_path(digest)
+		if not object_path.is_file():
+			object_path.parent.mkdir(parents=True, exist_ok=True)
+			tmp_file = object_path.with_name(f"{digest}.{threading.get_ident()}.tmp")
+			tmp_file.write_bytes(data)
+			os.replace(str(tmp_file), str(object_path))
+
+		with self._lock:
+			self.index[key] = digest
+
+	def merge(self, other):
+		"""
+		Add the entries and files from another :class:`BuildCache`, e.g. from one shard of a sharded build.
+		"""
+
+		for key, digest in other.index.items():
+			object_path = self.object_path(digest)
+			if not object_path.is_file():
+				try:
+					data = other.object_path(digest).read_bytes()
+				except FileNotFoundError:
+					continue
+				object_path.parent.mkdir(parents=True, exist_ok=True)
+				object_path.write_bytes(data)
+
+			with self._lock:
+				self.index[key] = digest
+
+		self.costs.merge(other.costs)
+
+	def save(self):
+		self.cache_dir.mkdir(parents=True, exist_ok=True)
+		tmp_file = self.index_file.with_suffix(".tmp")
+
+		with self._lock:
+			tmp_file.write_text(json.dumps(self.index, indent=0, sort_keys=True))
+
+		os.replace(str(tmp_file), str(self.index_file))
+		self.costs.save()
+
+
+class CostHistory:
+	"""
+	How long the icon for each output file took to render in previous builds,
+	used to render the slowest icons first.
+
+	The time for a file is a moving average of the last few builds (see :data:`COST_HISTORY_WEIGHT`).
+	Icons with no history are estimated from :func:`estimate_cost`, scaled by how long the icons
+	that do have a history took compared to their estimates.
+	"""
+
+	def __init__(self, costs_file):
+		self.costs_file = pathlib.Path(costs_file)
+		self._lock = threading.Lock()
+
+		try:
+			self.jobs = json.loads(self.costs_file.read_text())
+		except (OSError, ValueError):
+			self.jobs = {}
+
+	def record(self, job, seconds):
+		"""
+		Record that rendering the icon for ``job`` took ``seconds``.
+		"""
+
+		with self._lock:
+			entry = self.jobs.get(job.outfile)
+			if entry is not None:
+				seconds = COST_HISTORY_WEIGHT * seconds + (1 - COST_HISTORY_WEIGHT) * entry["seconds"]
+
+			self.jobs[job.outfile] = {"source": job.source, "seconds": seconds, "estimate": estimate_cost(job)}
+
+	def get_seconds_per_cost(self):
+		"""
+		Returns how many seconds one unit of :func:`estimate_cost` has taken on average,
+		or :py:obj:`None` if there is no history.
+		"""
+
+		with self._lock:
+			entries = list(self.jobs.values())
+
+		estimated = sum(entry["estimate"] for entry in entries)
+		if not estimated:
+			return None
+
+		return sum(entry["seconds"] for entry in entries) / estimated
+
+	def estimate_time(self, job, status="stale", seconds_per_cost=None):
+		"""
+		Returns the expected time in seconds to produce the output for ``job``,
+		or its :func:`estimate_cost` if there is no history at all.
+
+		:param status: As returned by :func:`get_job_status`.
+		:param seconds_per_cost: The result of :meth:`get_seconds_per_cost`, if already known.
+		"""
+
+		if status == "stale":
+			entry = self.jobs.get(job.outfile)
+			if entry is not None:
+				return entry["seconds"]
+
+		if seconds_per_cost is None:
+			seconds_per_cost = self.get_seconds_per_cost() or 1.0
+
+		return estimate_cost(job, status) * seconds_per_cost
+
+	def get_sheet_times(self):
+		"""
+		Returns a mapping of source SVGs to the total time their icons took to render.
+		"""
+
+		totals = collections.defaultdict(float)
+
+		with self._lock:
+			for entry in self.jobs.values():
+				totals[entry["source"]] += entry["seconds"]
+
+		return totals
+
+	def merge(self, other):
+		"""
+		Add the history from another :class:`CostHistory`, e.g. from one shard of a sharded build.
+		"""
+
+		with self._lock:
+			self.jobs.update(other.jobs)
+
+	def save(self):
+		self.costs_file.parent.mkdir(parents=True, exist_ok=True)
+		tmp_file = self.costs_file.with_suffix(".tmp")
+
+		with self._lock:
+			tmp_file.write_text(json.dumps(self.jobs, indent=0, sort_keys=True))
+
+		os.replace(str(tmp_file), str(self.costs_file))
+
+
+class BuildProfile:
+	"""
+	Records how long each stage of producing each icon takes.
+
+	For each stage of each icon it records the wall time, the time spent waiting for other processes
+	(Inkscape, optipng or worker processes), the size of the input and output files,
+	and whether the result was restored from the build cache.
+	"""
+
+	#: The fields of each record.
+	fields = ["icon", "stage", "wall_time", "subprocess_time", "bytes_in", "bytes_out", "cache_hit"]
+
+	# The files profiles have been written to by this build, kept apart from those of write_plan().
+	_written_files = set()
+
+	def __init__(self):
+		self.records = []
+
+		#: The batches of icons rendered, in the order they were scheduled.
+		self.batches = []
+
+		self._lock = threading.Lock()
+		self._local = threading.local()
+
+	@contextlib.contextmanager
+	def stage(self, icon, stage, input_file=None, output_file=None):
+		"""
+		Time a stage of producing ``icon``.
+
+		Yields the record for the stage, which the caller may update, e.g. to set ``cache_hit``.
+
+		:param input_file: The file the stage reads, to record the size of.
+		:param output_file: The file the stage writes, to record the size of.
+		"""
+
+		record = {
+				"icon": str(icon),
+				"stage": stage,
+				"wall_time": 0.0,
+				"subprocess_time": 0.0,
+				"bytes_in": get_file_size(input_file),
+				"bytes_out": 0,
+				"cache_hit": False,
+				}
+
+		stack = self._local.__dict__.setdefault("stack", [])
+		stack.append(record)
+		start = time.perf_counter()
+
+		try:
+			yield record
+		finally:
+			record["wall_time"] += time.perf_counter() - start
+			record["bytes_out"] = get_file_size(output_file)
+			stack.pop()
+
+			with self._lock:
+				self.records.append(record)
+
+	def add_subprocess_time(self, seconds):
+		"""
+		Add to the time the current thread's current stage spent waiting for another process.
+		"""
+
+		stack = self._local.__dict__.get("stack")
+		if stack:
+			stack[-1]["subprocess_time"] += seconds
+
+	def add(self, record):
+		with self._lock:
+			self.records.append(record)
+
+	def add_batch(self, order, jobs, estimated_time, wall_time):
+		"""
+		Record how long a batch of ``jobs`` took to render, against how long it was expected to take.
+
+		:param order: The position in which the batch was scheduled.
+		"""
+
+		with self._lock:
+			self.batches.append({
+					"order": order,
+					"icons": [str(job.outfile) for job in jobs],
+					"estimated_time": estimated_time,
+					"wall_time": wall_time,
+					})
+
+	def get_icon_times(self):
+		"""
+		Returns a mapping of icons to their total wall time, slowest first.
+		"""
+
+		totals = collections.defaultdict(float)
+		for record in self.records:
+			totals[record["icon"]] += record["wall_time"]
+
+		return collections.OrderedDict(sorted(totals.items(), key=lambda item: item[1], reverse=True))
+
+	def get_stage_times(self):
+		"""
+		Returns a mapping of stages to their total wall time, subprocess time and cache hits.
+		"""
+
+		stages = collections.OrderedDict()
+
+		for record in self.records:
+			totals = stages.setdefault(record["stage"], {"count": 0, "wall_time": 0.0, "subprocess_time": 0.0, "cache_hits": 0})
+			totals["count"] += 1
+			totals["wall_time"] += record["wall_time"]
+			totals["subprocess_time"] += record["subprocess_time"]
+			totals["cache_hits"] += record["cache_hit"]
+
+		return stages
+
+	def write(self, profile_file):
+		"""
+		Write the records to ``profile_file``, as CSV if its name ends in ``.csv`` and as a line of JSON otherwise.
+
+		Like :func:`write_plan`, the first profile written to a file by a build replaces its contents,
+		and later ones are added to the end.
+		"""
+
+		append = profile_file in self._written_files
+		self._written_files.add(profile_file)
+
+		with self._lock:
+			records = list(self.records)
+			batches = sorted(self.batches, key=lambda batch: batch["order"])
+
+		if str(profile_file).endswith(".csv"):
+			with open(profile_file, 'a' if append else 'w', newline='') as fp:
+				writer = csv.DictWriter(fp, self.fields)
+				if not append:
+					writer.writeheader()
+				writer.writerows(records)
+		else:
+			with open(profile_file, 'a' if append else 'w') as fp:
+				data = {"records": records, "stages": self.get_stage_times(), "batches": batches}
+				fp.write(json.dumps(data) + '\n')
+
+	def print_summary(self, top=10):
+		"""
+		Print the total time for each stage, the ``top`` slowest icons,
+		and the ``top`` slowest batches with how long they were expected to take.
+		"""
+
+		print("Stage                   Count    Wall time    Subprocess   Cache hits")
+		for stage, totals in self.get_stage_times().items():
+			print(
+					f"{stage:<20} {totals['count']:>8} {totals['wall_time']:>11.2f}s "
+					f"{totals['subprocess_time']:>11.2f}s {totals['cache_hits']:>12}"
+					)
+
+		print(f"Slowest {top} icons:")
+		for icon, wall_time in list(self.get_icon_times().items())[:top]:
+			print(f"{wall_time:>10.2f}s  {icon}")
+
+		if self.batches:
+			print(f"Slowest {top} batches (order scheduled, estimated time, wall time, first icon):")
+			for batch in sorted(self.batches, key=lambda batch: batch["wall_time"], reverse=True)[:top]:
+				print(
+						f"{batch['order']:>6} {batch['estimated_time']:>10.2f} {batch['wall_time']:>10.2f}s  "
+						f"{batch['icons'][0]}"
+						)
+
+
+def get_file_size(filename):
+	if filename is None:
+		return 0
+
+	try:
+		return os.stat(filename).st_size
+	except OSError:
+		return 0
+
+
+@contextlib.contextmanager
+def profile_stage(profile, icon, stage, input_file=None, output_file=None):
+	"""
+	Time a stage with :meth:`BuildProfile.stage`, if ``profile`` isn't :py:obj:`None`.
+	"""
+
+	if profile is None:
+		yield {}
+	else:
+		with profile.stage(icon, stage, input_file, output_file) as record:
+			yield record
+
+
+@contextlib.contextmanager
+def profile_subprocess(profile):
+	"""
+	Count the time spent in the ``with`` block as time spent waiting for another process.
+	"""
+
+	start = time.perf_counter()
+
+	try:
+		yield
+	finally:
+		if profile is not None:
+			profile.add_subprocess_time(time.perf_counter() - start)
+
+
+# Held while starting a subprocess, or the workers of a process pool (see start_process_pool()).
+_process_start_lock = threading.Lock()
+
+
+def start_process_pool(workers):
+	"""
+	Returns a :class:`concurrent.futures.ProcessPoolExecutor` with its worker processes already started.
+
+	Where processes are forked, a worker forked while another thread is starting Inkscape or optipng
+	would inherit the pipe :class:`subprocess.Popen` waits on, leaving that thread stuck until the pool is shut down.
+	The workers are therefore started straight away, while no other thread is starting a subprocess.
+	"""
+
+	with _process_start_lock:
+		executor = concurrent.futures.ProcessPoolExecutor(workers)
+		executor.submit(int).result()
+
+	return executor
+
+
+class ScratchWorkspace:
+	"""
+	A directory for intermediate files, made once for the whole build and removed by :meth:`close`.
+
+	Each worker thread gets its own subdirectory, which it reuses for every file it works on.
+
+	:param parent: The directory to make the workspace in. Defaults to :func:`default_scratch_dir`.
+	"""
+
+	def __init__(self, parent=None):
+		directory = tempfile.mkdtemp(prefix="custom_wx_icons-", dir=parent or default_scratch_dir())
+
+		#: The workspace's directory.
+		self.directory = pathlib.Path(directory)
+
+		self._local = threading.local()
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, exc_type, exc_val, exc_tb):
+		self.close()
+
+	def get_worker_directory(self):
+		"""
+		Returns the subdirectory for the current thread.
+		"""
+
+		directory = getattr(self._local, "directory", None)
+
+		if directory is None:
+			directory = self.directory / str(threading.get_ident())
+			directory.mkdir(exist_ok=True)
+			self._local.directory = directory
+
+		return directory
+
+	def close(self):
+		shutil.rmtree(str(self.directory), ignore_errors=True)
+
+
+class PNGOptimizer:
+	"""
+	Optimises rendered PNGs in a pool of ``workers``, separately from rendering them.
+
+	With optipng each worker runs it in its own process, on a copy of the PNG in its directory of ``scratch``,
+	so the output file is only written once, when it has been optimised.
+	The builtin optimiser runs in a process pool, and is passed the PNG in memory.
+	If ``cache`` is given, the optimised PNG is cached by the hash of the unoptimised one,
+	so identical renders are only optimised once.
+
+	:param effort: The level of optimisation. One of the keys of :data:`PNG_EFFORT_LEVELS`.
+	:param optimizer: ``"optipng"`` or ``"builtin"``. Defaults to optipng if it is installed.
+	:param profile: A :class:`BuildProfile` to record the time taken in.
+	:param scratch: A :class:`ScratchWorkspace` for optipng's copies of the PNGs.
+		If not given one is made and removed with the optimiser.
+	"""
+
+	def __init__(self, workers=1, effort="release", cache=None, optimizer=None, profile=None, scratch=None):
+		if effort not in PNG_EFFORT_LEVELS:
+			raise ValueError(f"Unknown PNG optimisation effort {effort!r}")
+
+		self.workers = max(1, int(workers))
+		self.effort = effort
+		self.cache = cache
+		self.optimizer = optimizer or get_png_optimizer()
+		self.profile = profile
+		self._executor = concurrent.futures.ThreadPoolExecutor(self.workers)
+		self._pending = threading.BoundedSemaphore(self.workers * PIPELINE_QUEUE_SIZE)
+
+		if self.optimizer == "builtin" and PNG_EFFORT_LEVELS[effort] is not None:
+			self._processes = start_process_pool(self.workers)
+		else:
+			self._processes = None
+
+		self._owns_scratch = scratch is None and self._processes is None
+		self.scratch = ScratchWorkspace() if self._owns_scratch else scratch
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, exc_type, exc_val, exc_tb):
+		self.close()
+
+	def get_cache_key(self, png_data):
+		data = {
+				"version": CACHE_VERSION,
+				"png": hashlib.sha256(png_data).hexdigest(),
+				"effort": self.effort,
+				"optimizer": self.optimizer,
+				"optipng": get_tool_versions()["optipng"] if self.optimizer == "optipng" else None,
+				}
+
+		return hashlib.sha256(json.dumps(data, sort_keys=True).encode("UTF-8")).hexdigest()
+
+	def _optimize(self, data):
+		# Returns the optimised PNG data.
+		if self._processes is not None:
+			with profile_subprocess(self.profile):
+				return self._processes.submit(optimize_png_data, data, self.effort).result()
+
+		scratch_file = self.scratch.get_worker_directory() / "optimize.png"
+		scratch_file.write_bytes(data)
+
+		with profile_subprocess(self.profile if self.optimizer == "optipng" else None):
+			optimize_png(scratch_file, self.effort, self.optimizer)
+
+		return scratch_file.read_bytes()
+
+	def optimize(self, png_file):
+		"""
+		Optimise ``png_file`` in place.
+
+		:return: Whether the optimised file was restored from the cache.
+		"""
+
+		png_file = pathlib.Path(png_file)
+
+		with profile_stage(self.profile, png_file, "optimize_png", png_file, png_file) as record:
+			data = png_file.read_bytes()
+
+			if self.cache is not None:
+				key = self.get_cache_key(data)
+				if self.cache.restore(key, png_file):
+					record["cache_hit"] = True
+					return True
+
+			optimized = self._optimize(data)
+			if optimized != data:
+				png_file.write_bytes(optimized)
+
+			if self.cache is not None:
+				self.cache.store(key, png_file)
+
+			return False
+
+	def submit(self, png_file, callback=None):
+		"""
+		Queue ``png_file`` to be optimised, and then call ``callback`` with no arguments.
+
+		Waits first if there are already :data:`PIPELINE_QUEUE_SIZE` files queued for each worker.
+
+		:rtype: :class:`concurrent.futures.Future`
+		"""
+
+		self._pending.acquire()
+
+		def task():
+			try:
+				self.optimize(png_file)
+				if callback is not None:
+					callback()
+			finally:
+				self._pending.release()
+
+		try:
+			return self._executor.submit(task)
+		except BaseException:
+			self._pending.release()
+			raise
+
+	def close(self):
+		self._executor.shutdown()
+
+		if self._processes is not None:
+			self._processes.shutdown()
+
+		if self._owns_scratch:
+			self.scratch.close()
+
+
+def minify_svg_string(svg_string):
+	# use scour to remove redundant stuff
+	return scour.scourString(svg_string, ScourOptions())
+
+
+def minify_svg(input_file, output_file):
+	# Read SVG file
+	svg_string = pathlib.Path(input_file).read_text()
+
+	svg_string = minify_svg_string(svg_string)
+
+	with open(output_file, 'w') as fp:
+		fp.write(svg_string)
+
+
+class SVGMinifier:
+	"""
+	Minifies rendered SVGs with scour in a pool of ``workers`` processes, separately from rendering them.
+	The processes are only started once the first SVG is submitted, as many builds don't have any.
+
+	If ``cache`` is given, the minified SVG is cached by the hash of the unminified one and the scour options,
+	so identical exports are only minified once.
+
+	:param profile: A :class:`BuildProfile` to record the time taken in.
+	"""
+
+	def __init__(self, workers=1, cache=None, profile=None):
+		self.workers = max(1, int(workers))
+		self.cache = cache
+		self.profile = profile
+		self._executor = concurrent.futures.ThreadPoolExecutor(self.workers)
+		self._pending = threading.BoundedSemaphore(self.workers * PIPELINE_QUEUE_SIZE)
+		self._processes = None
+		self._processes_lock = threading.Lock()
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, exc_type, exc_val, exc_tb):
+		self.close()
+
+	def get_cache_key(self, svg_data):
+		data = {
+				"version": CACHE_VERSION,
+				"svg": hashlib.sha256(svg_data).hexdigest(),
+				"scour": get_scour_options(),
+				"scour_version": get_tool_versions()["scour"],
+				}
+
+		return hashlib.sha256(json.dumps(data, sort_keys=True).encode("UTF-8")).hexdigest()
+
+	def minify(self, svg_file):
+		"""
+		Minify ``svg_file`` in place.
+
+		:return: Whether the minified file was restored from the cache.
+		"""
+
+		svg_file = pathlib.Path(svg_file)
+
+		with profile_stage(self.profile, svg_file, "scour", svg_file, svg_file) as record:
+			data = svg_file.read_bytes()
+
+			if self.cache is not None:
+				key = self.get_cache_key(data)
+				if self.cache.restore(key, svg_file):
+					record["cache_hit"] = True
+					return True
+
+			with profile_subprocess(self.profile):
+				svg_string = self._get_processes().submit(minify_svg_string, data.decode("UTF-8")).result()
+
+			svg_file.write_text(svg_string, encoding="UTF-8")
+
+			if self.cache is not None:
+				self.cache.store(key, svg_file)
+
+			return False
+
+	def submit(self, svg_file, callback=None):
+		"""
+		Queue ``svg_file`` to be minified, and then call ``callback`` with no arguments.
+
+		Waits first if there are already :data:`PIPELINE_QUEUE_SIZE` files queued for each worker.
+
+		:rtype: :class:`concurrent.futures.Future`
+		"""
+
+		self._get_processes()
+		self._pending.acquire()
+
+		def task():
+			try:
+				self.minify(svg_file)
+				if callback is not None:
+					callback()
+			finally:
+				self._pending.release()
+
+		try:
+			return self._executor.submit(task)
+		except BaseException:
+			self._pending.release()
+			raise
+
+	def _get_processes(self):
+		with self._processes_lock:
+			if self._processes is None:
+				self._processes = start_process_pool(self.workers)
+
+			return self._processes
+
+	def close(self):
+		self._executor.shutdown()
+
+		if self._processes is not None:
+			self._processes.shutdown()
+
+
+def stop_inkscape(process, timeout=10):
+	"""
+	Ask an ``inkscape --shell`` process to quit, killing it if it hasn't after ``timeout`` seconds.
+
+	If ``timeout`` is ``0`` the process is killed straight away.
+	"""
+
+	if process.poll() is None:
+		try:
+			if not timeout:
+				raise subprocess.TimeoutExpired(process.args, timeout)
+			process.stdin.write(b"quit\n")
+			process.stdin.close()
+			process.wait(timeout)
+		except (OSError, subprocess.TimeoutExpired):
+			process.kill()
+			process.wait()
+
+	process.stdin.close()
+	process.stdout.close()
+	if process.stderr is not None:
+		process.stderr.close()
+
+
+class InkscapePool:
+	"""
+	A pool of long-lived ``inkscape --shell`` processes that are shared between renders.
+
+	Processes are started on demand, up to ``size`` of them, and are all shut down by :meth:`close`.
+
+	:param timeout: The longest to wait for Inkscape to respond to a command, in seconds.
+	"""
+
+	def __init__(self, size=1, timeout=INKSCAPE_TIMEOUT):
+		self.size = max(1, int(size))
+		self.timeout = timeout
+		self._slots = threading.BoundedSemaphore(self.size)
+		self._idle = queue.LifoQueue()
+		self._processes = []
+		self._lock = threading.Lock()
+		self._closed = False
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, exc_type, exc_val, exc_tb):
+		self.close()
+
+	def acquire(self):
+		if self._closed:
+			raise ValueError("The Inkscape pool has been closed.")
+
+		self._slots.acquire()
+
+		try:
+			return self._idle.get_nowait()
+		except queue.Empty:
+			pass
+
+		try:
+			process = IconBuilder.start_inkscape(self.timeout)
+		except BaseException:
+			self._slots.release()
+			raise
+
+		with self._lock:
+			self._processes.append(process)
+
+		return process
+
+	def release(self, process):
+		if process.poll() is None and not self._closed:
+			self._idle.put(process)
+			self._slots.release()
+		else:
+			self.discard(process)
+
+	def discard(self, process):
+		with self._lock:
+			if process in self._processes:
+				self._processes.remove(process)
+
+		stop_inkscape(process, timeout=0)
+		self._slots.release()
+
+	@contextlib.contextmanager
+	def process(self):
+		process = self.acquire()
+
+		try:
+			yield process
+		except BaseException:
+			# The shell may be part way through a command, so don't hand it out again.
+			self.discard(process)
+			raise
+		else:
+			self.release(process)
+
+	def close(self):
+		self._closed = True
+
+		with self._lock:
+			processes = self._processes
+			self._processes = []
+
+		for process in processes:
+			stop_inkscape(process)
+
+
+class IconBuilder:
+
+	def __init__(
+			self,
+			infile,
+			outfile,
+			icon_name,
+			dpi,
+			id,
+			scalable,
+			pool=None,
+			optimize=True,
+			profile=None,
+			minify=True,
+			):
+		self.inkscape_process = None
+		self.optimize = optimize
+		self.minify = minify
+		self.profile = profile
+		self.pool = pool
+		self._owns_pool = pool is None
+
+		try:
+			self.render_icon(infile, outfile, icon_name, dpi, id, scalable)
+		except BaseException:
+			self.release_inkscape(failed=True)
+			raise
+		else:
+			self.release_inkscape()
+
+	@staticmethod
+	def start_inkscape(timeout=INKSCAPE_TIMEOUT):
+		# stderr is read separately so the crash banner can be seen, except on Windows,
+		# where select() doesn't work with pipes, so it is left going to the console.
+		with _process_start_lock:
+			process = subprocess.Popen(["inkscape", "--shell"],
+										bufsize=0,
+										stdin=subprocess.PIPE,
+										stdout=subprocess.PIPE,
+										stderr=subprocess.PIPE if os.name == "posix" else None)
+
+		try:
+			wait_for_prompt(process, timeout=timeout)
+		except BaseException:
+			stop_inkscape(process, timeout=0)
+			raise
+
+		return process
+
+	def get_inkscape(self):
+		if self.inkscape_process is None:
+			if self.pool is None:
+				self.pool = InkscapePool()
+			self.inkscape_process = self.pool.acquire()
+
+		return self.inkscape_process
+
+	def run_inkscape(self, cmd):
+		process = self.get_inkscape()
+
+		with profile_subprocess(self.profile):
+			return wait_for_prompt(process, ' '.join(cmd), timeout=self.pool.timeout)
+
+	def release_inkscape(self, failed=False):
+		if self.inkscape_process is not None:
+			if failed:
+				self.pool.discard(self.inkscape_process)
+			else:
+				self.pool.release(self.inkscape_process)
+			self.inkscape_process = None
+
+		if self._owns_pool and self.pool is not None:
+			self.pool.close()
+			self.pool = None
+
+	def inkscape_render_rect(self, icon_file, rect, dpi, output_file):
+		cmd = [
+				icon_file,
+				"--export-dpi",
+				str(dpi),
+				"-i",
+				rect,
+				"-e",
+				output_file,
+				]
+
+		self.run_inkscape(cmd)
+
+		if self.optimize:
+			optimize_png(output_file)
+
+	def make_svg_from_source(self, input_file, output_file, icon_name, dpi, id):
+		with profile_stage(self.profile, output_file, "extract_svg", input_file, output_file):
+			svg_string = extract_icon_svg(input_file, icon_name, id)
+
+		if self.minify:
+			with profile_stage(self.profile, output_file, "scour", input_file, output_file):
+				svg_string = minify_svg_string(svg_string)
+
+		pathlib.Path(output_file).write_text(svg_string, encoding="UTF-8")
+
+	def render_icon(self, infile, outfile, icon_name, dpi, id, scalable):
+		if scalable:
+			self.make_svg_from_source(infile, outfile, icon_name, dpi, id)
+		else:
+			with profile_stage(self.profile, outfile, "export_png", infile, outfile):
+				self.inkscape_render_rect(infile, id, dpi, outfile)
+
+
+class RenderBackend:
+	"""
+	Base class for the ways of producing icons from the source SVGs.
+
+	:param workers: The number of icons the backend should be able to render at once.
+	:param profile: A :class:`BuildProfile` to record the time taken in.
+	"""
+
+	#: The most jobs from one source SVG to pass to :meth:`render_batch` at once.
+	batch_size = 1
+
+	def __init__(self, workers=1, profile=None):
+		self.workers = max(1, int(workers))
+		self.profile = profile
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, exc_type, exc_val, exc_tb):
+		self.close()
+
+	def render(self, job):
+		"""
+		Produce the output file for a :class:`RenderJob`.
+
+		This may be called from several threads at once.
+		"""
+
+		raise NotImplementedError
+
+	def render_batch(self, jobs):
+		"""
+		Produce the output files for several jobs (see :class:`RenderJob`) from the same source SVG.
+		"""
+
+		for job in jobs:
+			self.render(job)
+
+	def close(self):
+		pass
+
+
+class InkscapeBackend(RenderBackend):
+	"""
+	Renders icons with a pool of ``inkscape --shell`` processes.
+
+	:param pool: An existing :class:`InkscapePool` to use. If not given one is created and closed with the backend.
+	:param retries: The number of times to retry a job if Inkscape crashes, exits or hangs.
+		The failed process is replaced with a new one each time.
+
+	PNGs are left unoptimised, for a :class:`PNGOptimizer` to take care of,
+	and SVGs unminified, for a :class:`SVGMinifier`.
+	"""
+
+	def __init__(self, workers=1, pool=None, retries=2, profile=None):
+		super().__init__(workers, profile)
+		self._owns_pool = pool is None
+		self.pool = pool or InkscapePool(self.workers)
+		self.retries = retries
+
+	@property
+	def batch_size(self):
+		# Only Inkscape 1.x can export several PNGs without reloading the document
+		return INKSCAPE_BATCH_SIZE if get_inkscape_version() >= (1, 0) else 1
+
+	def render(self, job):
+		if job.scalable:
+			with profile_stage(self.profile, job.outfile, "extract_svg", job.source, job.outfile):
+				write_icon_svg(job)
+			return
+
+		if get_inkscape_version() >= (1, 0):
+			self.export_pngs([job])
+			return
+
+		for attempt in range(self.retries + 1):
+			try:
+				IconBuilder(
+						job.source,
+						job.outfile,
+						job.icon_name,
+						96 * job.dpi_factor,
+						job.rect,
+						job.scalable,
+						self.pool,
+						optimize=False,
+						profile=self.profile,
+						minify=False,
+						)
+				return
+			except OSError:
+				if attempt == self.retries:
+					raise
+
+	def render_batch(self, jobs):
+		"""
+		Produce the output files for several jobs (see :class:`RenderJob`) from the same source SVG.
+
+		With Inkscape 1.0 and newer the PNGs are exported with a single list of actions,
+		so the document is only loaded once. Older versions reload the document for every command,
+		so each job is rendered separately.
+		"""
+
+		png_jobs = [job for job in jobs if not job.scalable]
+
+		if png_jobs and get_inkscape_version() >= (1, 0):
+			self.export_pngs(png_jobs)
+		else:
+			for job in png_jobs:
+				self.render(job)
+
+		for job in jobs:
+			if job.scalable:
+				self.render(job)
+
+	def export_pngs(self, jobs):
+		"""
+		Export the PNGs for the given jobs, which must all be from the same source SVG,
+		using Inkscape 1.x's shell actions.
+
+		The time taken is shared equally between the jobs in the profile.
+		"""
+
+		actions = [f"file-open:{jobs[0].source}"]
+		for job in jobs:
+			actions.extend([
+					f"export-filename:{job.outfile}",
+					f"export-id:{job.rect}",
+					f"export-dpi:{96 * job.dpi_factor}",
+					"export-do",
+					])
+		actions.append("file-close")
+
+		start = time.perf_counter()
+
+		for attempt in range(self.retries + 1):
+			try:
+				with self.pool.process() as process:
+					wait_for_prompt(process, ';'.join(actions), timeout=self.pool.timeout * len(jobs))
+				break
+			except OSError:
+				if attempt == self.retries:
+					raise
+
+		if self.profile is not None:
+			elapsed = (time.perf_counter() - start) / len(jobs)
+			for job in jobs:
+				self.profile.add({
+						"icon": job.outfile,
+						"stage": "export_png",
+						"wall_time": elapsed,
+						"subprocess_time": elapsed,
+						"bytes_in": get_file_size(job.source),
+						"bytes_out": get_file_size(job.outfile),
+						"cache_hit": False,
+						})
+
+	def close(self):
+		if self._owns_pool:
+			self.pool.close()
+
+
+_REFERENCE_RE = re.compile(r"url\(\s*['\"]?#([^)'\"\s]+)")
+
+
+def get_references(element):
+	"""
+	Returns the ids referred to by ``element`` and its descendants, with ``url(#id)`` or ``href="#id"``.
+	"""
+
+	ids = set()
+
+	for child in element.iter(etree.Element):
+		for name, value in child.attrib.items():
+			if name in {f"{{{XLINK}}}href", "href"}:
+				if value.startswith('#'):
+					ids.add(value[1:])
+			else:
+				ids.update(_REFERENCE_RE.findall(value))
+
+	return ids
+
+
+def show_element(element):
+	"""
+	Remove ``display:none`` from ``element``, e.g. a hidden layer which is to be exported.
+	"""
+
+	if element.get("display") == "none":
+		del element.attrib["display"]
+
+	style = element.get("style")
+	if style:
+		declarations = [
+				declaration for declaration in style.split(';')
+				if declaration.replace(' ', '').lower() != "display:none"
+				]
+		element.set("style", ';'.join(declarations))
+
+
+class SourceTree:
+	"""
+	A parsed source SVG, shared by everything working on the sheet at the same time.
+
+	A whole parsed sheet can take a lot of memory, so it is only kept while something has it open
+	(see :meth:`open`), and is only parsed once something needs it.
+	"""
+
+	_open = {}
+	_open_lock = threading.Lock()
+
+	def __init__(self, source_file, stat_key):
+		self.source_file = str(source_file)
+
+		#: The modification time and size of the file when it was opened.
+		self.stat_key = stat_key
+
+		#: Held while the tree is being used, as :meth:`crop_to_rect` changes it temporarily.
+		self.lock = threading.Lock()
+
+		self._root = None
+		self._ids = None
+		self._users = 0
+
+	@classmethod
+	def open(cls, source_file):
+		"""
+		Returns the :class:`SourceTree` for ``source_file``, which is shared until everything using it
+		has called :meth:`close`, or left the ``with`` block it was used in.
+		"""
+
+		stat = os.stat(str(source_file))
+		key = (str(source_file), stat.st_mtime_ns, stat.st_size)
+
+		with cls._open_lock:
+			source_tree = cls._open.get(key)
+			if source_tree is None:
+				source_tree = cls._open[key] = cls(source_file, key[1:])
+			source_tree._users += 1
+
+		return source_tree
+
+	def close(self):
+		with self._open_lock:
+			self._users -= 1
+			if not self._users:
+				del self._open[(self.source_file, *self.stat_key)]
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, exc_type, exc_val, exc_tb):
+		self.close()
+
+	def _load(self):
+		# Returns the root element, parsing the file the first time. Must be called with the lock held.
+		if self._root is None:
+			self._root = etree.parse(self.source_file, etree.XMLParser(huge_tree=True)).getroot()
+			self._ids = {
+					element.get("id"): element
+					for element in self._root.iter(etree.Element)
+					if element.get("id")
+					}
+
+		return self._root
+
+	def extract_icon_svg(self, icon_name, rect_id):
+		"""
+		Returns the scalable SVG for ``icon_name`` (see :func:`extract_icon_svg`).
+		"""
+
+		layer_ids = SourceSheetIndex.for_file(self.source_file).get_icon_layer_ids(icon_name)
+
+		def is_layer(element, label):
+			return (
+					element.get(f"{{{INKSCAPE}}}groupmode") == "layer"
+					and (element.get(f"{{{INKSCAPE}}}label") or '').lower().startswith(label)
+					)
+
+		with self.lock:
+			root = self._load()
+			x, y, width, height = get_rect_bounds(self._ids, rect_id)
+
+			container = self._ids[layer_ids[0]] if layer_ids else root
+			hires_layers = [layer for layer in container.iter(f"{{{SVG}}}g") if is_layer(layer, "hires")]
+
+			if hires_layers:
+				elements = hires_layers[:1]
+			elif layer_ids:
+				elements = [container]
+			else:
+				elements = [
+						element for element in root.iterchildren(f"{{{SVG}}}g")
+						if not is_layer(element, "baseplate")
+						]
+
+			# Use SVG as the default namespace, so the elements aren't written with an "svg:" prefix
+			nsmap = {prefix: uri for prefix, uri in root.nsmap.items() if uri != SVG}
+			nsmap[None] = SVG
+
+			svg = etree.Element(f"{{{SVG}}}svg", nsmap=nsmap)
+			for name, value in root.attrib.items():
+				if name not in {"width", "height", "viewBox"}:
+					svg.set(name, value)
+
+			svg.set("viewBox", f"{x:g} {y:g} {width:g} {height:g}")
+			svg.set("width", f"{width:g}")
+			svg.set("height", f"{height:g}")
+			defs = etree.SubElement(svg, f"{{{SVG}}}defs")
+
+			for element in elements:
+				# Keep the transforms of the groups the element was in
+				matrix = (1, 0, 0, 1, 0, 0)
+				for ancestor in reversed(list(element.iterancestors())[:-1]):
+					matrix = multiply_matrices(matrix, parse_transform(ancestor.get("transform")))
+
+				clone = copy.deepcopy(element)
+				show_element(clone)
+
+				if matrix == (1, 0, 0, 1, 0, 0):
+					svg.append(clone)
+				else:
+					transform = f"matrix({','.join(f'{value:g}' for value in matrix)})"
+					group = etree.SubElement(svg, f"{{{SVG}}}g", transform=transform)
+					group.append(clone)
+
+			# Add the gradients, patterns, clones etc. that are referred to, and the ones they refer to in turn.
+			copied = {element.get("id") for element in svg.iter(etree.Element) if element.get("id")}
+			pending = get_references(svg) - copied
+
+			while pending:
+				# Copy them in a fixed order, so the same source always gives the same SVG.
+				element_id = min(pending)
+				pending.remove(element_id)
+
+				element = self._ids.get(element_id)
+				if element is None:
+					continue
+
+				clone = copy.deepcopy(element)
+				defs.append(clone)
+				copied.update(child.get("id") for child in clone.iter(etree.Element) if child.get("id"))
+				pending.update(get_references(clone) - copied)
+
+		if not len(defs):
+			svg.remove(defs)
+
+		return etree.tostring(svg, encoding="unicode")
+
+	def crop_to_rect(self, rect_id, scale=1):
+		"""
+		Returns the source SVG as a string, with its viewport set to the area of the given rect.
+
+		:param scale: The size of the output in pixels per user unit.
+		"""
+
+		with self.lock:
+			root = self._load()
+			original_attrib = dict(root.attrib)
+			x, y, width, height = get_rect_bounds(self._ids, rect_id)
+
+			try:
+				root.set("viewBox", f"{x} {y} {width} {height}")
+				root.set("width", str(round(width * scale)))
+				root.set("height", str(round(height * scale)))
+				return etree.tostring(root, encoding="unicode")
+			finally:
+				root.attrib.clear()
+				root.attrib.update(original_attrib)
+
+
+def extract_icon_svg(source_file, icon_name, rect_id):
+	"""
+	Returns the scalable SVG for ``icon_name``, built directly from the source SVG without Inkscape.
+
+	That is the icon's layer (or just its ``hires`` layer, if it has one) and everything it refers to,
+	with the viewport set to the area of the given rect.
+	If the source SVG doesn't have a layer for the icon, its ``hires`` layer or all its layers except
+	the baseplates are used instead.
+	"""
+
+	with SourceTree.open(source_file) as source_tree:
+		return source_tree.extract_icon_svg(icon_name, rect_id)
+
+
+def crop_svg_to_rect(source_file, rect_id, scale=1):
+	"""
+	Returns the source SVG as a string, with its viewport set to the area of the given rect.
+
+	:param scale: The size of the output in pixels per user unit.
+	"""
+
+	with SourceTree.open(source_file) as source_tree:
+		return source_tree.crop_to_rect(rect_id, scale)
+
+
+def cairosvg_render_rect(icon_file, rect, dpi, output_file):
+	# 3rd party
+	import cairosvg  # Imported here so builds using Inkscape don't need libcairo
+
+	cairosvg.svg2png(bytestring=crop_svg_to_rect(icon_file, rect, dpi / 96).encode("UTF-8"), write_to=str(output_file))
+
+
+def write_icon_svg(job):
+	"""
+	Write the scalable SVG for ``job``, reusing the one extracted when the jobs were collected if there is one.
+	"""
+
+	svg_string = job.svg
+	if svg_string is None:
+		svg_string = extract_icon_svg(job.source, job.icon_name, job.rect)
+
+	pathlib.Path(job.outfile).write_text(svg_string, encoding="UTF-8")
+
+
+def cairosvg_render_job(job):
+	if job.scalable:
+		write_icon_svg(job)
+	else:
+		cairosvg_render_rect(job.source, job.rect, 96 * job.dpi_factor, job.outfile)
+
+
+# The source SVG the last job in this worker process was from, kept open for the next one.
+_worker_source_tree = None
+
+
+def cairosvg_render_worker_job(job):
+	"""
+	Render ``job`` in a worker process, keeping its source SVG parsed for the next job from the same sheet.
+	"""
+
+	global _worker_source_tree
+
+	source_tree = SourceTree.open(job.source)
+	if _worker_source_tree is not None:
+		_worker_source_tree.close()
+	_worker_source_tree = source_tree
+
+	cairosvg_render_job(job)
+
+
+class CairoSVGBackend(RenderBackend):
+	"""
+	Renders icons in-process with cairosvg, so Inkscape isn't required.
+
+	Icons are rendered in a pool of ``workers`` processes. PNGs are left unoptimised and SVGs unminified.
+	"""
+
+	def __init__(self, workers=1, profile=None):
+		super().__init__(workers, profile)
+
+		if self.workers > 1:
+			self._executor = start_process_pool(self.workers)
+		else:
+			self._executor = None
+
+	def render(self, job):
+		with profile_stage(self.profile, job.outfile, "render", job.source, job.outfile):
+			# There is nothing to gain from sending an already extracted SVG to another process to be written.
+			if self._executor is None or job.svg is not None:
+				cairosvg_render_job(job)
+			else:
+				with profile_subprocess(self.profile):
+					self._executor.submit(cairosvg_render_worker_job, job).result()
+
+	def close(self):
+		if self._executor is not None:
+			self._executor.shutdown()
+
+
+BACKENDS = {"inkscape": InkscapeBackend, "cairosvg": CairoSVGBackend}
+
+
+# ``width`` and ``height`` are the size of the rect, and ``dpi_factor`` the multiplier it is rendered at.
+# ``target_width``, ``target_height`` and ``scale`` are the size and scale of the output,
+# which differ from the rect's when it is used for a size the icon has no rect for.
+# ``svg`` is the SVG extracted for a scalable icon when the jobs were collected, or None.
+RenderJob = collections.namedtuple(
+		"RenderJob",
+		[
+				"source",
+				"context",
+				"icon_name",
+				"rect",
+				"width",
+				"height",
+				"target_width",
+				"target_height",
+				"dpi_factor",
+				"scale",
+				"scalable",
+				"outfile",
+				"stale",
+				"cache_key",
+				"downsample_from",
+				"svg",
+				],
+		)
+
+
+def find_icons(source_file, filter=None):
+	icons = SourceSheetIndex.for_file(source_file).icons
+
+	if filter is not None:
+		icons = [icon for icon in icons if icon.icon_name in filter]
+
+	return icons
+
+
+def index_source_sheet(source_file):
+	"""
+	Returns the :class:`SourceSheetIndex` for ``source_file``. Used to index source SVGs in a process pool.
+	"""
+
+	return SourceSheetIndex.for_file(source_file)
+
+
+def iter_sheet_indexes(source_files, executor=None, prefetch=PIPELINE_QUEUE_SIZE):
+	"""
+	Yields the :class:`SourceSheetIndex` for each of ``source_files`` in turn.
+
+	If ``executor`` is given the files are indexed in it, up to ``prefetch`` files ahead,
+	and each index is added to those returned by :meth:`SourceSheetIndex.for_file`.
+	"""
+
+	if executor is None:
+		for source_file in source_files:
+			yield SourceSheetIndex.for_file(source_file)
+		return
+
+	pending = collections.deque()
+	source_files = iter(source_files)
+
+	try:
+		while True:
+			for source_file in itertools.islice(source_files, prefetch - len(pending)):
+				pending.append(executor.submit(index_source_sheet, source_file))
+
+			if not pending:
+				return
+
+			index = pending.popleft().result()
+			SourceSheetIndex.add_to_cache(index)
+			yield index
+	finally:
+		for future in pending:
+			future.cancel()
+
+
+def iter_sheet_icons(source_files, filter=None, prefetch=None, workers=1):
+	"""
+	Yields the icons in each of ``source_files`` in turn (see :func:`find_icons`).
+
+	The files are parsed in a background thread, up to ``prefetch`` files ahead,
+	so the icons from one file can be rendered while the next is being parsed.
+	With more than one worker they are parsed in a process pool of up to ``workers`` processes.
+
+	:param prefetch: Defaults to :data:`PIPELINE_QUEUE_SIZE` files for each process parsing them.
+	"""
+
+	source_files = list(source_files)
+	processes = min(workers, len(source_files))
+
+	if processes > 1:
+		executor = start_process_pool(processes)
+	else:
+		executor = None
+		processes = 1
+
+	if prefetch is None:
+		prefetch = PIPELINE_QUEUE_SIZE * processes
+
+	results = queue.Queue(maxsize=prefetch)
+	stop = threading.Event()
+	done = object()
+
+	def parse():
+		indexes = iter_sheet_indexes(source_files, executor, prefetch)
+
+		while True:
+			try:
+				index = next(indexes, None)
+				if index is None:
+					break
+
+				icons = index.icons
+				if filter is not None:
+					icons = [icon for icon in icons if icon.icon_name in filter]
+
+				item = (icons, None)
+			except Exception as e:
+				item = (None, e)
+
+			while not stop.is_set():
+				try:
+					results.put(item, timeout=0.1)
+					break
+				except queue.Full:
+					pass
+
+			if stop.is_set() or item[1] is not None:
+				indexes.close()
+				return
+
+		results.put(done)
+
+	thread = threading.Thread(target=parse, daemon=True)
+	thread.start()
+
+	try:
+		while True:
+			item = results.get()
+			if item is done:
+				return
+
+			icons, error = item
+			if error is not None:
+				raise error
+
+			yield icons
+	finally:
+		stop.set()
+		thread.join()
+
+		if executor is not None:
+			executor.shutdown()
+
+
+def plan_downsampling(jobs):
+	"""
+	For the jobs for one rect, find the PNG jobs that can be made by downsampling the one at the highest DPI,
+	i.e. those where the ratio between the DPIs is a whole number.
+
+	Icons no bigger than :data:`DOWNSAMPLE_HINTED_SIZE` are usually hinted to line up with the pixel grid,
+	which averaging the larger render loses, so they are always rendered at their own DPI.
+
+	:return: A mapping of the positions of those jobs in ``jobs`` to the position of the highest DPI job.
+	"""
+
+	png_positions = [position for position, job in enumerate(jobs) if not job.scalable]
+	if len(png_positions) < 2:
+		return {}
+
+	largest = max(png_positions, key=lambda position: jobs[position].dpi_factor)
+	parents = {}
+
+	for position in png_positions:
+		job = jobs[position]
+		if max(job.width, job.height) * job.dpi_factor <= DOWNSAMPLE_HINTED_SIZE:
+			continue
+
+		ratio = jobs[largest].dpi_factor / job.dpi_factor
+		if ratio > 1 and ratio == int(ratio):
+			parents[position] = largest
+
+	return parents
+
+
+class OutputTree:
+	"""
+	The files in the output directories, listed with one :func:`os.scandir` call per directory
+	the first time it is needed, rather than checking for each output file separately.
+
+	Files are only passed to :func:`os.stat` when their modification time is needed.
+	"""
+
+	def __init__(self):
+		self._directories = {}
+
+	def list_directory(self, directory):
+		"""
+		Returns a mapping of the names of the files in ``directory`` to their :class:`os.DirEntry`,
+		or :py:obj:`None` if it doesn't exist.
+		"""
+
+		if directory not in self._directories:
+			try:
+				with os.scandir(directory) as entries:
+					self._directories[directory] = {entry.name: entry for entry in entries if entry.is_file()}
+			except (FileNotFoundError, NotADirectoryError):
+				self._directories[directory] = None
+
+		return self._directories[directory]
+
+	def get_entry(self, filename):
+		files = self.list_directory(os.path.dirname(filename))
+		if files is None:
+			return None
+
+		return files.get(os.path.basename(filename))
+
+	def exists(self, filename):
+		return self.get_entry(filename) is not None
+
+	def stat(self, filename):
+		"""
+		Returns the :class:`os.stat_result` for ``filename``, or :py:obj:`None` if it doesn't exist.
+		"""
+
+		entry = self.get_entry(filename)
+		return None if entry is None else entry.stat()
+
+	def makedirs(self, directory):
+		if self.list_directory(directory) is None:
+			os.makedirs(directory, exist_ok=True)
+			self._directories[directory] = {}
+
+	def unlink(self, filename):
+		os.unlink(filename)
+		self.list_directory(os.path.dirname(filename)).pop(os.path.basename(filename), None)
+
+
+_THEME_DIRECTORY_RE = re.compile(r"^(\d+)x(\d+)(?:@(\d+)x)?/(.+)$")
+
+
+def get_missing_sizes(icon, dpis, theme_directories):
+	"""
+	Returns the ``(width, height, dpi_factor)`` of the directories in ``theme_directories`` for the icon's context
+	which the icon has no rect for, for the DPI multipliers in ``dpis``.
+	"""
+
+	sizes = {(int(float(rect["width"])), int(float(rect["height"]))) for rect in icon.rects}
+	missing = set()
+
+	for directory in theme_directories:
+		match = _THEME_DIRECTORY_RE.match(directory)
+		if match is None:
+			# e.g. "scalable/apps"
+			continue
+
+		width, height, dpi_factor, context = match.groups()
+		width, height, dpi_factor = int(width), int(height), int(dpi_factor or 1)
+
+		if context == icon.context and (width, height) not in sizes and dpi_factor in dpis:
+			missing.add((width, height, dpi_factor))
+
+	return sorted(missing)
+
+
+def collect_jobs(
+		icons,
+		dpis,
+		output_dir,
+		scalable_directories,
+		force=False,
+		cache=None,
+		backend="inkscape",
+		png_effort="release",
+		png_optimizer="optipng",
+		downsample=False,
+		output_tree=None,
+		theme_directories=None,
+		):
+	"""
+	Returns a :class:`RenderJob` for every rect and DPI of the given icons,
+	and marks whether each output is out of date.
+
+	Nothing is written to disk; see :func:`prepare_output`.
+
+	If ``cache`` is given the build cache key is calculated for each out of date job,
+	for rendering with the named ``backend`` and optimising PNGs with the given optimiser and effort.
+
+	If ``downsample`` is :py:obj:`True`, PNGs at lower DPIs are made from the one at the highest DPI
+	where possible (see :func:`plan_downsampling`).
+
+	:param output_tree: The :class:`OutputTree` to check the existing output files with.
+		Pass the same one to :func:`prepare_output`.
+	:param theme_directories: The directories of the icon theme (see :func:`get_theme_directories`).
+		If given, the sizes an icon has no rect for are made by rendering its largest rect at that size
+		(see :func:`get_missing_sizes`).
+	"""
+
+	if output_tree is None:
+		output_tree = OutputTree()
+
+	source_mtimes = {}
+	jobs = []
+	source_tree = None
+
+	try:
+		for icon in icons:
+			if cache is not None and (source_tree is None or source_tree.source_file != str(icon.source)):
+				# Keep each sheet parsed while its icons are extracted
+				if source_tree is not None:
+					source_tree.close()
+				source_tree = SourceTree.open(icon.source)
+
+			if theme_directories and icon.rects:
+				missing_sizes = get_missing_sizes(icon, dpis, theme_directories)
+				largest_rect = max(icon.rects, key=lambda rect: float(rect["width"]))
+			else:
+				missing_sizes = []
+				largest_rect = None
+
+			for rect in icon.rects:
+				rect_jobs = []
+				width = int(float(rect["width"]))
+				height = int(float(rect["height"]))
+
+				# The size of each output, and the DPI multiplier to render the rect at to get it.
+				targets = [(width, height, dpi_factor, dpi_factor) for dpi_factor in dpis]
+
+				if rect is largest_rect:
+					for target_width, target_height, dpi_factor in missing_sizes:
+						render_factor = dpi_factor * target_width / width
+						targets.append((target_width, target_height, dpi_factor, render_factor))
+
+				for target_width, target_height, dpi_factor, render_factor in targets:
+					size_str = f"{target_width}x{target_height}"
+					if dpi_factor != 1:
+						size_str += "@%sx" % dpi_factor
+
+					directory = os.path.join(output_dir, size_str, icon.context)
+
+					scalable = bool(f"{size_str}/{icon.context}" in scalable_directories)
+
+					if scalable:
+						outfile = os.path.join(directory, icon.icon_name + ".svg")
+					else:
+						outfile = os.path.join(directory, icon.icon_name + ".png")
+
+					# Do a time based check!
+					if force or not output_tree.exists(outfile):
+						stale = True
+					else:
+						if icon.source not in source_mtimes:
+							source_mtimes[icon.source] = os.stat(icon.source).st_mtime
+						stale = source_mtimes[icon.source] > output_tree.stat(outfile).st_mtime
+
+					rect_jobs.append(
+							RenderJob(
+									icon.source,
+									icon.context,
+									icon.icon_name,
+									rect["id"],
+									width,
+									height,
+									target_width,
+									target_height,
+									render_factor,
+									dpi_factor,
+									scalable,
+									outfile,
+									stale,
+									None,
+									None,
+									None,
+									)
+							)
+
+				parents = plan_downsampling(rect_jobs) if downsample else {}
+
+				if cache is not None:
+					svg_digest = None
+
+					for position, job in enumerate(rect_jobs):
+						if not job.stale:
+							continue
+
+						if job.scalable:
+							# Scalable SVGs are keyed on exactly what is extracted for them.
+							if svg_digest is None:
+								svg_string = source_tree.extract_icon_svg(icon.icon_name, rect["id"])
+								svg_digest = hashlib.sha256(svg_string.encode("UTF-8")).hexdigest()
+							source_digest = svg_digest
+						else:
+							# PNGs include everything visible in the area of the rect, wherever it is
+							# in the document, apart from the layers of the other icons in the sheet.
+							source_digest = SourceSheetIndex.for_file(icon.source).png_digests[icon.icon_name]
+
+						cache_key = get_cache_key(
+								source_digest,
+								rect,
+								96 * job.dpi_factor,
+								job.scalable,
+								backend,
+								png_effort,
+								png_optimizer,
+								rect_jobs[parents[position]].dpi_factor if position in parents else None,
+								)
+						if job.scalable:
+							# Reuse the extracted SVG when the job is rendered
+							job = job._replace(svg=svg_string)
+						rect_jobs[position] = job._replace(cache_key=cache_key)
+
+				for position, parent in parents.items():
+					rect_jobs[position] = rect_jobs[position]._replace(downsample_from=rect_jobs[parent])
+
+				jobs.extend(rect_jobs)
+	finally:
+		if source_tree is not None:
+			source_tree.close()
+
+	return jobs
+
+
+def prepare_output(jobs, output_tree=None):
+	"""
+	Create the output directories for the stale jobs, and remove any PNG for a scalable icon
+	(or SVG for a non-scalable one) left over from a previous build.
+
+	Output files for stale jobs which are hardlinked to others (see :func:`dedupe_outputs`) are removed too,
+	so writing the new icon doesn't change the others.
+
+	:param output_tree: The :class:`OutputTree` the jobs were collected with.
+	"""
+
+	if output_tree is None:
+		output_tree = OutputTree()
+
+	for job in jobs:
+		output_tree.makedirs(os.path.dirname(job.outfile))
+
+		other_file = os.path.splitext(job.outfile)[0] + (".png" if job.scalable else ".svg")
+		if output_tree.exists(other_file):
+			output_tree.unlink(other_file)
+
+		if job.stale and output_tree.exists(job.outfile) and output_tree.stat(job.outfile).st_nlink > 1:
+			output_tree.unlink(job.outfile)
+
+
+def dedupe_outputs(jobs):
+	"""
+	Replace the output files of ``jobs`` that have the same contents with hardlinks to a single copy.
+
+	Each group of identical files is linked to the most recently modified one.
+	Files which can't be hardlinked, e.g. because the filesystem doesn't support it, are left as they are.
+
+	:return: A dictionary with the number of ``files`` and ``unique`` files,
+		their total size in ``bytes`` and ``unique_bytes``, and the ``ratio`` between the two.
+	"""
+
+	by_digest = collections.OrderedDict()
+	total_bytes = 0
+
+	for job in jobs:
+		try:
+			data = pathlib.Path(job.outfile).read_bytes()
+		except FileNotFoundError:
+			# It couldn't be rendered
+			continue
+
+		total_bytes += len(data)
+		by_digest.setdefault(hashlib.sha256(data).hexdigest(), []).append(job.outfile)
+
+	unique_bytes = 0
+
+	for filenames in by_digest.values():
+		# Link to the newest copy, so none of the files ends up older than it was and looks out of date.
+		original = max(filenames, key=lambda filename: os.stat(filename).st_mtime_ns)
+		unique_bytes += os.stat(original).st_size
+
+		for filename in filenames:
+			if os.path.samefile(original, filename):
+				continue
+
+			tmp_file = f"{filename}.{os.getpid()}.tmp"
+			try:
+				os.link(original, tmp_file)
+			except OSError:
+				continue
+			os.replace(tmp_file, filename)
+
+	return {
+			"files": sum(len(filenames) for filenames in by_digest.values()),
+			"unique": len(by_digest),
+			"bytes": total_bytes,
+			"unique_bytes": unique_bytes,
+			"ratio": total_bytes / unique_bytes if unique_bytes else 1.0,
+			}
+
+
+# Rough relative costs of the different ways of producing an icon, for planning builds.
+COST_RENDER = 1.0
+COST_RENDER_PER_MEGAPIXEL = 20.0
+COST_SCALABLE = 3.0
+COST_DOWNSAMPLE = 0.1
+COST_CACHED = 0.01
+
+# How much the time an icon took in the latest build counts towards its expected time, against earlier builds.
+COST_HISTORY_WEIGHT = 0.5
+
+
+def get_job_status(job, cache=None):
+	"""
+	Returns ``"up-to-date"``, ``"cached"`` (can be restored from ``cache``) or ``"stale"`` for ``job``.
+	"""
+
+	if not job.stale:
+		return "up-to-date"
+	elif job.cache_key is not None and cache is not None and cache.contains(job.cache_key):
+		return "cached"
+	else:
+		return "stale"
+
+
+def estimate_cost(job, status="stale"):
+	"""
+	Returns the estimated cost of producing the output for ``job``, relative to rendering a small PNG.
+	"""
+
+	if status == "up-to-date":
+		return 0
+	elif status == "cached":
+		return COST_CACHED
+	elif job.scalable:
+		return COST_SCALABLE
+	elif job.downsample_from is not None:
+		return COST_DOWNSAMPLE
+
+	megapixels = job.width * job.height * job.dpi_factor**2 / 1e6
+	return COST_RENDER + megapixels * COST_RENDER_PER_MEGAPIXEL
+
+
+def plan_build(jobs, cache=None):
+	"""
+	Returns the plan for building ``jobs``, without rendering anything, as a JSON-serialisable dictionary.
+
+	Each job is listed with its output path, status (see :func:`get_job_status`) and estimated cost,
+	and, if the build cache has a history of how long icons took, the expected time in seconds.
+	"""
+
+	planned_jobs = []
+	summary = collections.Counter()
+	total_cost = 0
+	total_time = 0
+
+	if cache is not None:
+		seconds_per_cost = cache.costs.get_seconds_per_cost()
+	else:
+		seconds_per_cost = None
+
+	for job in jobs:
+		status = get_job_status(job, cache)
+		cost = estimate_cost(job, status)
+
+		if seconds_per_cost is not None:
+			estimated_time = cache.costs.estimate_time(job, status, seconds_per_cost)
+			total_time += estimated_time
+		else:
+			estimated_time = None
+
+		planned_jobs.append({
+				"source": job.source,
+				"context": job.context,
+				"icon_name": job.icon_name,
+				"rect": job.rect,
+				"size": [job.target_width, job.target_height],
+				"dpi": 96 * job.scale,
+				"render_dpi": 96 * job.dpi_factor,
+				"scalable": job.scalable,
+				"output": job.outfile,
+				"downsample_from": job.downsample_from.outfile if job.downsample_from is not None else None,
+				"status": status,
+				"estimated_cost": round(cost, 3),
+				"estimated_time": round(estimated_time, 3) if estimated_time is not None else None,
+				})
+
+		summary[status] += 1
+		total_cost += cost
+
+	return {
+			"jobs": planned_jobs,
+			"summary": {
+					"jobs": len(jobs),
+					"stale": summary["stale"],
+					"cached": summary["cached"],
+					"up_to_date": summary["up-to-date"],
+					"estimated_cost": round(total_cost, 3),
+					"estimated_time": round(total_time, 3) if seconds_per_cost is not None else None,
+					},
+			}
+
+
+def parse_shard(shard):
+	"""
+	Parse a shard specification like ``"3/8"`` (the third of eight shards) into ``(3, 8)``.
+	"""
+
+	match = re.fullmatch(r"\s*(\d+)\s*/\s*(\d+)\s*", str(shard))
+	if match is None:
+		raise ValueError(f"Invalid shard {shard!r}; expected e.g. '3/8'")
+
+	index, count = int(match.group(1)), int(match.group(2))
+	if not 1 <= index <= count:
+		raise ValueError(f"Invalid shard {shard!r}; the shard number must be between 1 and {count}")
+
+	return index, count
+
+
+def select_shard(jobs, index, count):
+	"""
+	Returns the jobs in shard ``index`` (counting from 1) of ``count``.
+
+	The jobs are shared out so each shard has about the same estimated cost. The split only depends on
+	the source files, not on what has already been built or cached, so every machine taking part in a
+	sharded build agrees on it. Jobs downsampled from another job are kept in the same shard as it.
+	"""
+
+	units = collections.OrderedDict()
+	for job in jobs:
+		units.setdefault(job.downsample_from or job, []).append(job)
+
+	def unit_cost(unit):
+		return sum(estimate_cost(job) for job in unit)
+
+	# Longest processing time first, with ties broken by output path so the order is stable.
+	ordered = sorted(units.items(), key=lambda item: (-unit_cost(item[1]), item[0].outfile))
+
+	loads = [0] * count
+	selected = set()
+
+	for _, unit in ordered:
+		shard = loads.index(min(loads))
+		loads[shard] += unit_cost(unit)
+		if shard == index - 1:
+			selected.update(unit)
+
+	return [job for job in jobs if job in selected]
+
+
+def merge_shards(shard_output_dirs, output_dir, shard_cache_dirs=(), cache_dir=None):
+	"""
+	Combine the output trees (and optionally the build caches) of the shards of a sharded build.
+
+	Where more than one shard has the same file the newest is kept.
+
+	:param shard_cache_dirs: The build cache directories of the shards, to merge into ``cache_dir``.
+	:param cache_dir: The build cache to merge into. Defaults to ``~/.cache/custom_wx_icons``.
+
+	:return: The number of files copied into ``output_dir``.
+	"""
+
+	copied = 0
+
+	for shard_dir in shard_output_dirs:
+		for root, dirs, files in os.walk(shard_dir):
+			target_dir = os.path.join(output_dir, os.path.relpath(root, shard_dir))
+			os.makedirs(target_dir, exist_ok=True)
+
+			for filename in files:
+				source_file = os.path.join(root, filename)
+				target_file = os.path.join(target_dir, filename)
+
+				if not os.path.exists(target_file) or os.stat(source_file).st_mtime > os.stat(target_file).st_mtime:
+					shutil.copy2(source_file, target_file)
+					copied += 1
+
+	if shard_cache_dirs:
+		with BuildCache(cache_dir or default_cache_dir()) as cache:
+			for shard_cache_dir in shard_cache_dirs:
+				cache.merge(BuildCache(shard_cache_dir))
+
+	return copied
+
+
+_written_plan_files = set()
+
+
+def write_plan(plan, plan_file):
+	"""
+	Write ``plan`` to ``plan_file`` as a line of JSON, or to stdout if ``plan_file`` is ``"-"``.
+
+	The first plan written to a file by a build replaces its contents, and later ones
+	(e.g. for the other source directories) are added to the end.
+	"""
+
+	if plan_file == '-':
+		print(json.dumps(plan))
+		return
+
+	mode = 'a' if plan_file in _written_plan_files else 'w'
+	with open(plan_file, mode) as fp:
+		fp.write(json.dumps(plan) + '\n')
+
+	_written_plan_files.add(plan_file)
+
+
+def finish_job(job, cache=None, optimizer=None, minifier=None):
+	"""
+	Pass the output of a rendered job on to ``optimizer`` if it is a PNG, or ``minifier`` if it is an SVG,
+	and store it in the build cache.
+
+	:return: :py:obj:`False`, or a :class:`concurrent.futures.Future` that completes once the PNG has been optimised
+		or the SVG minified.
+	"""
+
+	if job.cache_key is not None:
+		store = functools.partial(cache.store, job.cache_key, job.outfile)
+	else:
+		store = None
+
+	if optimizer is not None and not job.scalable:
+		return optimizer.submit(job.outfile, callback=store)
+
+	if minifier is not None and job.scalable:
+		return minifier.submit(job.outfile, callback=store)
+
+	if store is not None:
+		store()
+
+	return False
+
+
+def restore_job(job, cache, profile=None):
+	"""
+	Restore the output of ``job`` from the build cache.
+
+	:return: Whether it was in the cache.
+	"""
+
+	if job.cache_key is None:
+		return False
+
+	with profile_stage(profile, job.outfile, "restore", output_file=job.outfile) as record:
+		record["cache_hit"] = cache.restore(job.cache_key, job.outfile)
+		return record["cache_hit"]
+
+
+def render_job(job, backend, cache=None, optimizer=None, minifier=None):
+	"""
+	Render the icon for ``job``, or restore it from the build cache if it has been rendered before.
+
+	PNGs are passed on to ``optimizer`` and SVGs to ``minifier``, in which case a :class:`concurrent.futures.Future`
+	is returned that completes once that has finished.
+
+	:return: Whether the icon was restored from the cache.
+	"""
+
+	if restore_job(job, cache, backend.profile):
+		return True
+
+	backend.render(job)
+	return finish_job(job, cache, optimizer, minifier)
+
+
+def render_batch(jobs, backend, cache=None, optimizer=None, minifier=None):
+	"""
+	Like :func:`render_job`, but for several jobs from the same source SVG,
+	which are rendered together with :meth:`RenderBackend.render_batch`.
+
+	:return: The result for each job.
+	"""
+
+	results = {}
+	to_render = []
+
+	for job in jobs:
+		if restore_job(job, cache, backend.profile):
+			results[job] = True
+		else:
+			to_render.append(job)
+
+	start = time.perf_counter()
+
+	rendered = [job for job in to_render if job.downsample_from is None]
+	if rendered:
+		backend.render_batch(rendered)
+
+	# The highest DPI PNGs have been rendered (or were already there), so make the others from them.
+	for job in to_render:
+		if job.downsample_from is not None:
+			factor = int(job.downsample_from.dpi_factor / job.dpi_factor)
+			with profile_stage(backend.profile, job.outfile, "downsample", job.downsample_from.outfile, job.outfile):
+				downsampled = downsample_png(job.downsample_from.outfile, job.outfile, factor)
+			if not downsampled:
+				backend.render(job)
+
+	if cache is not None and to_render:
+		# Share the time out between the jobs by their estimated cost.
+		elapsed = time.perf_counter() - start
+		total_cost = sum(estimate_cost(job) for job in to_render)
+		for job in to_render:
+			cache.costs.record(job, elapsed * estimate_cost(job) / total_cost)
+
+	for job in to_render:
+		results[job] = finish_job(job, cache, optimizer, minifier)
+
+	return [results[job] for job in jobs]
+
+
+def make_batches(jobs, batch_size=INKSCAPE_BATCH_SIZE):
+	"""
+	Group the stale PNG jobs into batches of up to ``batch_size`` jobs from the same source SVG.
+
+	Each scalable job is a batch of its own. Jobs to be downsampled from another stale job
+	are put in the same batch as that job, after it.
+	"""
+
+	children = collections.defaultdict(list)
+	for job in jobs:
+		if job.stale and job.downsample_from is not None and job.downsample_from.stale:
+			children[job.downsample_from].append(job)
+
+	by_source = collections.OrderedDict()
+	batches = []
+
+	for job in jobs:
+		if not job.stale or (job.downsample_from is not None and job.downsample_from.stale):
+			continue
+		elif job.scalable:
+			batches.append([job])
+		else:
+			by_source.setdefault(job.source, []).append([job, *children.get(job, [])])
+
+	for units in by_source.values():
+		for start in range(0, len(units), batch_size):
+			batches.append([job for unit in units[start:start + batch_size] for job in unit])
+
+	return batches
+
+
+def schedule_batches(batches, cache=None):
+	"""
+	Sort ``batches`` so the ones expected to take longest are rendered first, leaving the quick ones to fill
+	the gaps at the end, rather than one slow batch being left until last.
+
+	:return: A list of ``(batch, estimated_time)`` tuples. The times are from the history in ``cache``
+		where there is one (see :class:`CostHistory`), and from :func:`estimate_cost` otherwise.
+	"""
+
+	if cache is not None:
+		seconds_per_cost = cache.costs.get_seconds_per_cost() or 1.0
+
+	scheduled = []
+
+	for batch in batches:
+		if cache is not None:
+			estimated_time = sum(
+					cache.costs.estimate_time(job, get_job_status(job, cache), seconds_per_cost) for job in batch
+					)
+		else:
+			estimated_time = sum(estimate_cost(job) for job in batch)
+
+		scheduled.append((batch, estimated_time))
+
+	scheduled.sort(key=lambda item: item[1], reverse=True)
+	return scheduled
+
+
+def order_source_files(source_files, cache=None):
+	"""
+	Returns ``source_files`` with the ones expected to take longest to render first.
+
+	Sheets with a history in ``cache`` are ordered by how long their icons took.
+	Larger files are assumed to take longer, so the others are ordered by size,
+	scaled to match the sheets with a history if there are any.
+	"""
+
+	sizes = {source_file: os.path.getsize(source_file) for source_file in source_files}
+	sheet_times = cache.costs.get_sheet_times() if cache is not None else {}
+
+	known = [source_file for source_file in source_files if source_file in sheet_times]
+	known_size = sum(sizes[source_file] for source_file in known)
+	if known_size:
+		seconds_per_byte = sum(sheet_times[source_file] for source_file in known) / known_size
+	else:
+		seconds_per_byte = 1.0
+
+	def expected_time(source_file):
+		if source_file in sheet_times:
+			return sheet_times[source_file]
+		return sizes[source_file] * seconds_per_byte
+
+	return sorted(source_files, key=lambda source_file: (-expected_time(source_file), source_file))
+
+
+def render_jobs(jobs, backend, cache=None, optimizer=None, minifier=None):
+	"""
+	Render the stale jobs with the given :class:`RenderBackend`, up to ``backend.workers`` batches at once.
+
+	Jobs from the same source SVG are rendered in batches of up to ``backend.batch_size``,
+	the slowest batches first (see :func:`schedule_batches`). PNGs are optimised by ``optimizer``
+	and SVGs minified by ``minifier``, so the renderer can move on to the next batch straight away.
+
+	Progress is written in the order of ``jobs``, regardless of the order in which they finish:
+	``.`` for a rendered icon, ``=`` for one restored from the cache, and ``-`` for one that was up to date.
+	"""
+
+	render_job_groups([jobs], backend, cache, optimizer, minifier)
+
+
+def render_job_groups(job_groups, backend, cache=None, optimizer=None, minifier=None):
+	"""
+	Like :func:`render_jobs`, but for an iterable of lists of jobs, e.g. one for each source SVG,
+	which may still be being worked out while the first ones are rendered.
+
+	Once :data:`PIPELINE_QUEUE_SIZE` batches are waiting for each of the backend's workers,
+	no more jobs are taken from ``job_groups`` until they catch up.
+
+	Each source SVG is kept open (see :class:`SourceTree`) until all the batches from it that have been
+	submitted are finished, so it is only parsed once while its jobs are running.
+	"""
+
+	pending_batches = threading.BoundedSemaphore(backend.workers * PIPELINE_QUEUE_SIZE)
+	progress = collections.deque()
+	batch_of = {}
+	futures = []
+	current_icon = None
+	scheduled = 0
+
+	def run_batch(order, batch, estimated_time):
+		start = time.perf_counter()
+		try:
+			return render_batch(batch, backend, cache, optimizer, minifier)
+		finally:
+			if backend.profile is not None:
+				backend.profile.add_batch(order, batch, estimated_time, time.perf_counter() - start)
+
+	def write_progress(wait):
+		# Write the progress for the jobs at the front of the queue that have finished,
+		# or for all of them if ``wait`` is true.
+		nonlocal current_icon
+
+		while progress:
+			job = progress[0]
+			message = '-'
+
+			if job in batch_of:
+				future, position = batch_of[job]
+				if not wait and not future.done():
+					return
+
+				try:
+					result = future.result()[position]
+					if isinstance(result, concurrent.futures.Future):
+						if not wait and not result.done():
+							return
+						result = result.result()
+					message = '=' if result else '.'
+				except OSError:
+					message = f"Unable to process {job.source}.\n"
+
+			progress.popleft()
+
+			if current_icon != (job.source, job.icon_name):
+				if current_icon is not None:
+					sys.stdout.write('\n')
+				print(job.context, job.icon_name)
+				current_icon = (job.source, job.icon_name)
+
+			sys.stdout.write(message)
+			sys.stdout.flush()
+
+	with concurrent.futures.ThreadPoolExecutor(backend.workers) as executor:
+		try:
+			for jobs in job_groups:
+				# Hold the group's sheets open until all its batches have been submitted
+				source_trees = [SourceTree.open(source) for source in {job.source for job in jobs}]
+
+				try:
+					for batch, estimated_time in schedule_batches(make_batches(jobs, backend.batch_size), cache):
+						pending_batches.acquire()
+						source_tree = SourceTree.open(batch[0].source)
+						future = executor.submit(run_batch, scheduled, batch, estimated_time)
+						scheduled += 1
+						future.add_done_callback(lambda future, source_tree=source_tree: source_tree.close())
+						future.add_done_callback(lambda future: pending_batches.release())
+						futures.append(future)
+						for position, job in enumerate(batch):
+							batch_of[job] = (future, position)
+
+						write_progress(wait=False)
+				finally:
+					for source_tree in source_trees:
+						source_tree.close()
+
+				progress.extend(jobs)
+				write_progress(wait=False)
+
+			write_progress(wait=True)
+
+			if current_icon is not None:
+				sys.stdout.write('\n')
+				sys.stdout.flush()
+
+		except BaseException:
+			for future in futures:
+				future.cancel()
+			raise
+
+
+class SourceWatcher:
+	"""
+	Waits for the SVG files in a directory to change.
+
+	Uses inotify on Linux, and otherwise polls the directory every ``interval`` seconds.
+	"""
+
+	def __init__(self, directory, interval=1.0):
+		self.directory = directory
+		self.interval = interval
+		self._mtimes = self._scan()
+
+		try:
+			self._inotify = self._start_inotify()
+		except (OSError, AttributeError):
+			# AttributeError if libc doesn't have inotify.
+			self._inotify = None
+
+	def _start_inotify(self):
+		if not sys.platform.startswith("linux"):
+			raise OSError("inotify is only available on Linux")
+
+		libc = ctypes.CDLL(ctypes.util.find_library('c') or "libc.so.6", use_errno=True)
+
+		fd = libc.inotify_init1(os.O_CLOEXEC)
+		if fd < 0:
+			raise OSError(ctypes.get_errno(), "Unable to start inotify")
+
+		# Editors often save by writing a temporary file and renaming it over the original.
+		mask = IN_CLOSE_WRITE | IN_MOVED_TO | IN_MOVED_FROM | IN_DELETE
+		if libc.inotify_add_watch(fd, os.fsencode(self.directory), mask) < 0:
+			os.close(fd)
+			raise OSError(ctypes.get_errno(), f"Unable to watch {self.directory}")
+
+		return fd
+
+	def _scan(self):
+		mtimes = {}
+
+		for entry in os.scandir(self.directory):
+			if entry.name.endswith(".svg") and entry.is_file():
+				stat = entry.stat()
+				mtimes[entry.path] = (stat.st_mtime_ns, stat.st_size)
+
+		return mtimes
+
+	def _read_events(self, timeout):
+		changed = set()
+
+		while select.select([self._inotify], [], [], timeout)[0]:
+			data = os.read(self._inotify, 65536)
+			offset = 0
+
+			while offset < len(data):
+				_, _, _, length = struct.unpack_from("iIII", data, offset)
+				name = data[offset + 16:offset + 16 + length].rstrip(b"\0")
+				offset += 16 + length
+
+				if name.endswith(b".svg"):
+					changed.add(os.path.join(self.directory, os.fsdecode(name)))
+
+			# Wait for the rest of a burst of changes, e.g. from saving several files.
+			timeout = WATCH_SETTLE_TIME
+
+		return changed
+
+	def _poll(self):
+		time.sleep(self.interval)
+		mtimes = self._scan()
+		changed = {path for path in set(mtimes) | set(self._mtimes) if mtimes.get(path) != self._mtimes.get(path)}
+		self._mtimes = mtimes
+		return changed
+
+	def wait(self):
+		"""
+		Wait for SVG files to change.
+
+		:return: The paths of the files that were changed, added or removed.
+		"""
+
+		while True:
+			if self._inotify is not None:
+				changed = self._read_events(None)
+			else:
+				changed = self._poll()
+
+			if changed:
+				return changed
+
+	def close(self):
+		if self._inotify is not None:
+			os.close(self._inotify)
+			self._inotify = None
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, exc_type, exc_val, exc_tb):
+		self.close()
+
+
+def watch_icons(source_dir, icons, source_file=None, filter=None, interval=1.0):
+	"""
+	Wait for the SVG files in ``source_dir`` to change, and yield the icons that need to be rendered again.
+
+	An icon needs rendering again if the layers it is rendered from, or its rects on the baseplate, have changed,
+	or if it is new.
+
+	:param icons: The icons that have already been rendered.
+	:param source_file: Only watch this SVG file.
+	:param filter: Only watch these icons.
+	"""
+
+	def get_state(icon):
+		return SourceSheetIndex.for_file(icon.source).icon_digests[icon.icon_name], icon
+
+	known = {(icon.source, icon.context, icon.icon_name): get_state(icon) for icon in icons}
+
+	with SourceWatcher(source_dir, interval) as watcher:
+		while True:
+			changed_icons = []
+
+			for path in sorted(watcher.wait()):
+				if source_file is not None and os.path.abspath(path) != os.path.abspath(source_file):
+					continue
+
+				try:
+					sheet_icons = find_icons(path, filter=filter)
+				except (OSError, etree.XMLSyntaxError):
+					# Deleted, or still being written.
+					continue
+
+				sheet_keys = set()
+
+				for icon in sheet_icons:
+					key = (path, icon.context, icon.icon_name)
+					state = get_state(icon)
+					if known.get(key) != state:
+						changed_icons.append(icon)
+					known[key] = state
+					sheet_keys.add(key)
+
+				# Forget the icons that have been removed from the sheet.
+				for key in [key for key in known if key[0] == path and key not in sheet_keys]:
+					del known[key]
+
+			if changed_icons:
+				yield changed_icons
+
+
+def parse_args(argv=None):
+	parser = argparse.ArgumentParser(description="Render icons from the SVG sources of an icon theme.")
+	parser.add_argument(
+			"source",
+			nargs='?',
+			help="Only render icons from this source SVG (without the .svg extension), even if they are up to date.",
+			)
+	parser.add_argument("icons", nargs='*', help="Only render these icons from the source SVG.")
+	parser.add_argument(
+			"--dry-run", action="store_true", help="Work out what needs to be rendered, but don't render anything."
+			)
+	parser.add_argument(
+			"--dedupe",
+			action="store_true",
+			help="Hardlink output files that have the same contents to a single copy.",
+			)
+	parser.add_argument(
+			"--watch",
+			action="store_true",
+			help="After rendering, keep watching the source SVGs and render the icons that change.",
+			)
+	parser.add_argument(
+			"--shard",
+			metavar="N/COUNT",
+			help="Only render shard N of COUNT, e.g. 3/8, to spread the build over several machines.",
+			)
+	parser.add_argument(
+			"--profile",
+			metavar="FILE",
+			help="Record how long each stage of each icon takes, and write it to FILE as CSV (*.csv) or JSON.",
+			)
+	parser.add_argument(
+			"--profile-top",
+			metavar='N',
+			type=int,
+			default=10,
+			help="The number of slowest icons to list after a profiled build (default 10).",
+			)
+	parser.add_argument(
+			"--plan",
+			metavar="FILE",
+			help="Write the build plan to FILE as JSON, one line per source directory. Use '-' for stdout.",
+			)
+	parser.add_argument(
+			"--scratch-dir",
+			metavar="DIR",
+			help="The directory to keep intermediate files in while building (default /dev/shm if available).",
+			)
+	return parser.parse_args(argv)
+
+
+def main(
+		source_dir,
+		dpis,
+		output_dir,
+		scalable_directories,
+		inkscape_pool=None,
+		workers=None,
+		use_cache=True,
+		cache_dir=None,
+		backend="inkscape",
+		png_effort="release",
+		png_optimizer=None,
+		downsample=False,
+		dry_run=False,
+		plan_file=None,
+		shard=None,
+		watch=False,
+		profile_file=None,
+		dedupe=False,
+		theme_directories=None,
+		scratch_dir=None,
+		):
+	"""
+	Render the icons in the SVG files in ``source_dir`` into ``output_dir``.
+
+	Command line arguments are read from :py:data:`sys.argv` (see :func:`parse_args`).
+
+	:param workers: The number of icons to render at once. Defaults to the number of CPUs.
+	:param use_cache: Whether to restore unchanged icons from the build cache rather than rendering them again.
+	:param cache_dir: The directory of the build cache. Defaults to ``~/.cache/custom_wx_icons``.
+	:param backend: The name of the backend to render icons with. One of the keys of :data:`BACKENDS`.
+	:param png_effort: How hard to try to optimise PNGs. One of the keys of :data:`PNG_EFFORT_LEVELS`.
+		Use ``"fast"`` for development builds.
+	:param png_optimizer: ``"optipng"`` or ``"builtin"``. Defaults to optipng if it is installed.
+		Use ``"builtin"`` for output that doesn't depend on the tools installed on the build machine.
+	:param downsample: Whether to render each PNG once, at the highest DPI, and make the lower DPIs
+		by downsampling it where possible. Requires NumPy, from the ``downsample`` extra.
+	:param dry_run: Work out what needs to be rendered, but don't render anything or change ``output_dir``.
+	:param plan_file: Write the build plan (see :func:`plan_build`) to this file. ``"-"`` means stdout.
+	:param shard: Only render this shard of the jobs, e.g. ``"3/8"`` (see :func:`select_shard`).
+		Combine the output of the shards afterwards with :func:`merge_shards`.
+	:param watch: After rendering, keep watching ``source_dir`` and render the icons that change,
+		reusing the same Inkscape processes, until interrupted with :kbd:`Ctrl+C`.
+	:param profile_file: Record how long each stage of each icon takes (see :class:`BuildProfile`),
+		and write it to this file.
+	:param dedupe: Hardlink output files that have the same contents to a single copy (see :func:`dedupe_outputs`).
+	:param theme_directories: The directories of the icon theme (see :func:`get_theme_directories`).
+		If given, sizes which an icon has no rect for are made from its largest rect.
+	:param scratch_dir: The directory to keep intermediate files in while building (see :class:`ScratchWorkspace`).
+		Defaults to ``/dev/shm`` if it is available.
+	"""
+
+	args = parse_args(sys.argv[1:])
+	dry_run = dry_run or args.dry_run
+	plan_file = plan_file or args.plan
+	shard = shard or args.shard
+	watch = watch or args.watch
+	profile_file = profile_file or args.profile
+	dedupe = dedupe or args.dedupe
+	scratch_dir = scratch_dir or args.scratch_dir
+
+	if workers is None:
+		workers = os.cpu_count() or 1
+
+	png_optimizer = png_optimizer or get_png_optimizer()
+
+	source_file = None
+	filter = None
+
+	if args.source is None:
+		if not dry_run:
+			if not os.path.exists(output_dir):
+				os.mkdir(output_dir)
+			open(os.path.join(output_dir, "__init__.py"), 'w').close()
+			print("Rendering from SVGs in", source_dir)
+		source_files = [os.path.join(source_dir, file) for file in os.listdir(source_dir) if file[-4:] == ".svg"]
+		force = False
+	else:
+		source_file = os.path.join(source_dir, args.source + ".svg")
+		filter = args.icons or None
+		if os.path.exists(source_file):
+			source_files = [source_file]
+			force = True
+		else:
+			print("Error: No such file", source_file)
+			sys.exit(1)
+
+	if use_cache:
+		cache = BuildCache(cache_dir or default_cache_dir())
+	else:
+		cache = None
+
+	def get_jobs(icons, force, output_tree):
+		jobs = collect_jobs(
+				icons,
+				dpis,
+				output_dir,
+				scalable_directories,
+				force=force,
+				cache=cache,
+				backend=backend,
+				png_effort=png_effort,
+				png_optimizer=png_optimizer,
+				downsample=downsample,
+				output_tree=output_tree,
+				theme_directories=theme_directories,
+				)
+
+		if shard:
+			jobs = select_shard(jobs, *parse_shard(shard))
+
+		return jobs
+
+	output_tree = OutputTree()
+
+	# Planning and sharding need all the jobs to be known before anything is rendered.
+	# Otherwise the icons from each source SVG are rendered while the rest are still being parsed.
+	streaming = not (dry_run or plan_file or shard)
+
+	if not streaming:
+		sheets = iter_sheet_icons(source_files, filter, workers=workers)
+		icons = [icon for sheet_icons in sheets for icon in sheet_icons]
+		jobs = get_jobs(icons, force, output_tree)
+		job_groups = [jobs]
+	else:
+		icons = []
+		jobs = []
+
+		def iter_job_groups():
+			# Start on the sheets expected to take longest first, so they don't hold up the end of the build.
+			for sheet_icons in iter_sheet_icons(order_source_files(source_files, cache), filter, workers=workers):
+				# Keep the sheet parsed from when its icons are extracted until render_job_groups() takes it over
+				source_trees = [SourceTree.open(source) for source in {icon.source for icon in sheet_icons}]
+
+				try:
+					sheet_jobs = get_jobs(sheet_icons, force, output_tree)
+					prepare_output(sheet_jobs, output_tree)
+					icons.extend(sheet_icons)
+					jobs.extend(sheet_jobs)
+					yield sheet_jobs
+				finally:
+					for source_tree in source_trees:
+						source_tree.close()
+
+		job_groups = iter_job_groups()
+
+	if dry_run or plan_file:
+		plan = plan_build(jobs, cache)
+		plan["source_dir"] = source_dir
+		plan["output_dir"] = output_dir
+		plan["shard"] = shard
+
+		if plan_file:
+			write_plan(plan, plan_file)
+
+		if dry_run:
+			if plan_file != '-':
+				summary = plan["summary"]
+				if summary["estimated_time"] is not None:
+					estimate = f"estimated cost {summary['estimated_cost']}, about {summary['estimated_time']:.1f}s"
+				else:
+					estimate = f"estimated cost {summary['estimated_cost']}"
+				print(
+						f"{source_dir}: {summary['jobs']} icons, {summary['stale']} to render, "
+						f"{summary['cached']} in the cache and {summary['up_to_date']} up to date ({estimate})."
+						)
+			return
+
+	if not streaming:
+		prepare_output(jobs, output_tree)
+
+	if profile_file:
+		profile = BuildProfile()
+	else:
+		profile = None
+
+	if backend == "inkscape":
+		# Share one set of Inkscape processes between every icon in the build,
+		# unless the caller is managing the pool across several calls to main().
+		renderer = InkscapeBackend(workers, pool=inkscape_pool, profile=profile)
+	else:
+		renderer = BACKENDS[backend](workers, profile=profile)
+
+	try:
+		with ScratchWorkspace(scratch_dir) as scratch, \
+				PNGOptimizer(workers, png_effort, cache, png_optimizer, profile, scratch) as optimizer, \
+				SVGMinifier(workers, cache, profile) as minifier:
+			render_job_groups(job_groups, renderer, cache=cache, optimizer=optimizer, minifier=minifier)
+
+			if dedupe:
+				stats = dedupe_outputs(jobs)
+				print(
+						f"{stats['files']} icons, {stats['unique']} unique: "
+						f"{stats['bytes'] - stats['unique_bytes']} bytes saved by hardlinking duplicates "
+						f"(deduplication ratio {stats['ratio']:.2f})"
+						)
+
+			if watch:
+				if cache is not None:
+					cache.save()
+
+				print(f"Watching {source_dir} for changes. Press Ctrl+C to stop.")
+
+				try:
+					for changed_icons in watch_icons(source_dir, icons, source_file, filter):
+						output_tree = OutputTree()
+						jobs = get_jobs(changed_icons, True, output_tree)
+						prepare_output(jobs, output_tree)
+						render_jobs(jobs, renderer, cache=cache, optimizer=optimizer, minifier=minifier)
+
+						if cache is not None:
+							cache.save()
+				except KeyboardInterrupt:
+					pass
+	finally:
+		renderer.close()
+
+		if cache is not None:
+			cache.save()
+
+		if profile is not None:
+			profile.write(profile_file)
+			profile.print_summary(args.profile_top)
+
+
+def merge_main(argv=None):
+	"""
+	Command line entry point for merging the output of a sharded build. Used by ``merge_icon_shards.py``.
+	"""
+
+	parser = argparse.ArgumentParser(description="Combine the output of the shards of a sharded icon build.")
+	parser.add_argument("output_dir", help="The directory to combine the output into.")
+	parser.add_argument("shard_dirs", nargs='+', help="The output directories of the shards.")
+	parser.add_argument(
+			"--shard-cache",
+			action="append",
+			default=[],
+			metavar="DIR",
+			help="The build cache directory of a shard. May be given several times.",
+			)
+	parser.add_argument("--cache-dir", help="The build cache to merge the shards' caches into.")
+	args = parser.parse_args(argv)
+
+	copied = merge_shards(args.shard_dirs, args.output_dir, args.shard_cache, args.cache_dir)
+	print(f"Copied {copied} files into {args.output_dir}")
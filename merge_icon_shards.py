@@ -0,0 +1,36 @@
+#!/usr/bin/env python
+#
+#  merge_icon_shards.py
+"""
+Combine the output of the shards of a sharded icon build.
+
+e.g.
+
+	python merge_icon_shards.py Suru shard-1/Suru shard-2/Suru --shard-cache shard-1/cache --cache-dir cache
+
+See :func:`gnome_icon_builder.merge_shards`.
+"""
+#
+#  Copyright 2020 Dominic Davis-Foster <dominic@davis-foster.co.uk>
+#
+#  This program is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU Lesser General Public License as published by
+#  the Free Software Foundation; either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU Lesser General Public License for more details.
+#
+#  You should have received a copy of the GNU Lesser General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+#  MA 02110-1301, USA.
+#
+
+# this package
+from gnome_icon_builder import merge_main
+
+if __name__ == "__main__":
+	merge_main()
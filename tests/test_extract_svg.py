@@ -0,0 +1,199 @@
+# stdlib
+import os
+import pathlib
+import subprocess
+import sys
+import textwrap
+
+# 3rd party
+import pytest
+from lxml import etree
+
+# this package
+from gnome_icon_builder import (
+	BuildCache, CairoSVGBackend, SourceTree, collect_jobs, extract_icon_svg, find_icons, get_rect_bounds,
+	prepare_output, render_job_groups,
+	)
+
+SVG = "http://www.w3.org/2000/svg"
+
+SHEET = textwrap.dedent(
+		"""\
+		<svg xmlns="http://www.w3.org/2000/svg" xmlns:inkscape="http://www.inkscape.org/namespaces/inkscape"
+			xmlns:xlink="http://www.w3.org/1999/xlink" width="200" height="100">
+			<defs id="defs">
+				<linearGradient id="stops"><stop offset="0" style="stop-color:#729fcf"/></linearGradient>
+				<linearGradient id="gradient" xlink:href="#stops" x1="0" y1="0" x2="16" y2="16"/>
+				<radialGradient id="unused" xlink:href="#stops"/>
+			</defs>
+			<g inkscape:groupmode="layer" inkscape:label="baseplate">
+				<text inkscape:label="context">apps</text>
+				<text inkscape:label="icon-name">foo</text>
+				<rect id="rect-foo" x="10" y="20" width="32" height="32"/>
+			</g>
+			<g inkscape:groupmode="layer" inkscape:label="baseplate">
+				<text inkscape:label="context">apps</text>
+				<text inkscape:label="icon-name">bar</text>
+				<g transform="translate(100,0)"><rect id="rect-bar" x="0" y="0" width="16" height="16"/></g>
+			</g>
+			<g id="outer" transform="translate(10,20)">
+				<g id="layer-foo" inkscape:groupmode="layer" inkscape:label="foo" transform="scale(2)">
+					<path id="lowres-path" d="M 0,0 H 16 V 16 Z" style="fill:#ff0000"/>
+					<g id="hires-foo" inkscape:groupmode="layer" inkscape:label="hires" style="display:none">
+						<path id="hires-path" d="M 0,0 H 16 V 16 Z" style="fill:url(#gradient)"/>
+					</g>
+				</g>
+			</g>
+			<g id="layer-other" inkscape:groupmode="layer" inkscape:label="other">
+				<path id="other-path" d="M 100,0 H 116 V 16 Z"/>
+			</g>
+		</svg>
+		"""
+		)
+
+
+@pytest.fixture()
+def source_file(tmp_path):
+	source_file = tmp_path / "sheet.svg"
+	source_file.write_text(SHEET, encoding="UTF-8")
+	return str(source_file)
+
+
+def get_ids(svg):
+	return {element.get("id") for element in svg.iter() if element.get("id")}
+
+
+def test_hires_layer(source_file):
+	svg = etree.fromstring(extract_icon_svg(source_file, "foo", "rect-foo"))
+
+	assert svg.get("viewBox") == "10 20 32 32"
+	assert (svg.get("width"), svg.get("height")) == ("32", "32")
+
+	# Just the hires layer, shown, and in the groups' coordinates.
+	hires = svg.find(f".//{{{SVG}}}g[@id='hires-foo']")
+	assert "display:none" not in hires.get("style")
+	assert hires.getparent().get("transform") == "matrix(2,0,0,2,10,20)"
+	assert "lowres-path" not in get_ids(svg)
+	assert "other-path" not in get_ids(svg)
+
+
+def test_referenced_defs(source_file):
+	svg = etree.fromstring(extract_icon_svg(source_file, "foo", "rect-foo"))
+
+	# The gradient, and the one it refers to in turn, but not the unused one.
+	defs = svg.find(f"{{{SVG}}}defs")
+	assert [element.get("id") for element in defs] == ["gradient", "stops"]
+
+
+def test_deterministic(source_file):
+	assert extract_icon_svg(source_file, "foo", "rect-foo") == extract_icon_svg(source_file, "foo", "rect-foo")
+
+
+def test_no_layer_for_icon(tmp_path):
+	source_file = tmp_path / "no_hires.svg"
+	source_file.write_text(SHEET.replace('inkscape:label="hires"', 'inkscape:label="details"'), encoding="UTF-8")
+
+	svg = etree.fromstring(extract_icon_svg(str(source_file), "bar", "rect-bar"))
+
+	# The rect is in a transformed group.
+	assert svg.get("viewBox") == "100 0 16 16"
+
+	# Everything but the baseplates.
+	ids = get_ids(svg)
+	assert {"outer", "layer-foo", "lowres-path", "hires-foo", "layer-other", "other-path"} <= ids
+	assert "rect-foo" not in ids
+	assert "rect-bar" not in ids
+
+
+def test_no_layer_for_icon_hires(source_file):
+	# Without a layer for the icon, a hires layer is used if there is one.
+	svg = etree.fromstring(extract_icon_svg(source_file, "bar", "rect-bar"))
+	assert get_ids(svg) == {"hires-foo", "hires-path", "gradient", "stops"}
+
+
+NON_ASCII_SHEET = SHEET.replace('id="hires-path"', 'id="hires-path" inkscape:label="Café ☕"')
+
+
+def test_non_ascii(tmp_path):
+	source_file = tmp_path / "sheet.svg"
+	source_file.write_text(NON_ASCII_SHEET, encoding="UTF-8")
+
+	assert "Café ☕" in extract_icon_svg(str(source_file), "foo", "rect-foo")
+
+
+def test_write_on_ascii_locale(tmp_path):
+	source_file = tmp_path / "sheet.svg"
+	source_file.write_text(NON_ASCII_SHEET, encoding="UTF-8")
+	output_file = tmp_path / "foo.svg"
+
+	# The C locale, without Python switching to UTF-8 for it.
+	env = dict(os.environ, LC_ALL='C', PYTHONCOERCECLOCALE='0', PYTHONUTF8='0')
+	env["PYTHONPATH"] = os.pathsep.join(sys.path)
+
+	script = (
+			"from gnome_icon_builder import *\n"
+			f"job = RenderJob(*[None] * len(RenderJob._fields))._replace(source={str(source_file)!r}, "
+			f"icon_name='foo', rect='rect-foo', scalable=True, outfile={str(output_file)!r})\n"
+			"cairosvg_render_job(job)\n"
+			)
+	subprocess.run([sys.executable, "-c", script], env=env, check=True)
+
+	assert "Café ☕" in output_file.read_text(encoding="UTF-8")
+
+
+def test_get_rect_bounds(source_file):
+	root = etree.parse(source_file).getroot()
+	ids = {element.get("id"): element for element in root.iter() if element.get("id")}
+
+	assert get_rect_bounds(ids, "rect-foo") == (10, 20, 32, 32)
+	assert get_rect_bounds(ids, "rect-bar") == (100, 0, 16, 16)
+
+	with pytest.raises(ValueError, match="rect-baz"):
+		get_rect_bounds(ids, "rect-baz")
+
+
+@pytest.fixture()
+def parses(monkeypatch):
+	parses = []
+	parse = etree.parse
+
+	def counting_parse(source, *args, **kwargs):
+		parses.append(source)
+		return parse(source, *args, **kwargs)
+
+	monkeypatch.setattr(etree, "parse", counting_parse)
+	return parses
+
+
+def test_source_tree_shared(source_file, parses):
+	with SourceTree.open(source_file):
+		extract_icon_svg(source_file, "foo", "rect-foo")
+		extract_icon_svg(source_file, "bar", "rect-bar")
+
+	assert parses == [source_file]
+	assert not SourceTree._open
+
+	# Not kept once nothing has it open
+	extract_icon_svg(source_file, "foo", "rect-foo")
+	assert parses == [source_file, source_file]
+
+
+@pytest.mark.parametrize("use_cache", [True, False])
+def test_sheet_parsed_once(tmp_path, source_file, parses, use_cache):
+	output_dir = str(tmp_path / "output")
+	cache = BuildCache(tmp_path / "cache") if use_cache else None
+
+	jobs = collect_jobs(find_icons(source_file), [1], output_dir, ["16x16/apps", "32x32/apps"], cache=cache)
+	assert all(job.scalable for job in jobs)
+	assert all((job.svg is not None) == use_cache for job in jobs)
+	prepare_output(jobs)
+
+	with CairoSVGBackend() as backend:
+		render_job_groups([jobs], backend, cache)
+
+	assert parses == [source_file]
+	assert not SourceTree._open
+
+	for job in jobs:
+		svg_string = extract_icon_svg(source_file, job.icon_name, job.rect)
+		assert pathlib.Path(job.outfile).read_text(encoding="UTF-8") == svg_string
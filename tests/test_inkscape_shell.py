@@ -0,0 +1,68 @@
+# stdlib
+import os
+import subprocess
+import sys
+import textwrap
+
+# 3rd party
+import pytest
+
+# this package
+from gnome_icon_builder import stop_inkscape, wait_for_prompt
+
+pytestmark = pytest.mark.skipif(os.name != "posix", reason="stderr is only read separately on POSIX")
+
+# Stands in for ``inkscape --shell``, writing GTK-style warnings to stderr after each prompt.
+FAKE_SHELL = textwrap.dedent(
+		"""
+		import sys
+		out, err = sys.stdout.buffer, sys.stderr.buffer
+
+		out.write(b"Inkscape interactive shell mode.\\n> ")
+		out.flush()
+		err.write(b"Gtk-WARNING: cannot open display\\n")
+		err.flush()
+
+		for line in sys.stdin.buffer:
+			if line.strip() == b"quit":
+				break
+			elif line.strip() == b"crash":
+				err.write(b"Emergency save activated!\\n")
+				err.flush()
+				sys.stdin.buffer.read()
+			else:
+				out.write(b"done\\n> ")
+				out.flush()
+				err.write(b"Fontconfig warning: ignoring UTF-8\\n" * 100)
+				err.flush()
+		"""
+		)
+
+
+@pytest.fixture()
+def shell():
+	process = subprocess.Popen(
+			[sys.executable, "-c", FAKE_SHELL],
+			bufsize=0,
+			stdin=subprocess.PIPE,
+			stdout=subprocess.PIPE,
+			stderr=subprocess.PIPE,
+			)
+
+	yield process
+
+	stop_inkscape(process, timeout=0)
+
+
+def test_prompt_after_stderr_output(shell):
+	wait_for_prompt(shell, timeout=10)
+
+	for _ in range(20):
+		assert wait_for_prompt(shell, "export", timeout=10).strip() == b"done"
+
+
+def test_crash_banner(shell):
+	wait_for_prompt(shell, timeout=10)
+
+	with pytest.raises(OSError, match="crashed"):
+		wait_for_prompt(shell, "crash", timeout=10)
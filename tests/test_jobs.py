@@ -0,0 +1,158 @@
+# stdlib
+import os
+
+# 3rd party
+import pytest
+
+# this package
+from gnome_icon_builder import OutputTree, collect_jobs, find_icons, get_missing_sizes, select_shard
+
+SIZES = [16, 24, 32, 48, 64, 128]
+DPIS = [1, 2, 4]
+
+
+def write_sheet(source_file, icon_names, sizes=SIZES, context="apps"):
+	"""
+	Write a source SVG with a baseplate with a rect of each of the given sizes for each icon.
+	"""
+
+	layers = []
+
+	for icon_name in icon_names:
+		rects = ''.join(
+				f'<rect id="{icon_name}-{size}" x="{size * 2}" y="0" width="{size}" height="{size}"/>' for size in sizes
+				)
+		layers.append(
+				'<g inkscape:groupmode="layer" inkscape:label="baseplate">'
+				f'<text inkscape:label="context">{context}</text>'
+				f'<text inkscape:label="icon-name">{icon_name}</text>'
+				f"{rects}</g>"
+				)
+
+	source_file.write_text(
+			'<svg xmlns="http://www.w3.org/2000/svg" xmlns:inkscape="http://www.inkscape.org/namespaces/inkscape">'
+			f"{''.join(layers)}</svg>",
+			encoding="UTF-8",
+			)
+
+	return str(source_file)
+
+
+@pytest.fixture()
+def icons(tmp_path):
+	icons = []
+	for sheet in range(3):
+		source_file = write_sheet(tmp_path / f"sheet-{sheet}.svg", [f"icon-{sheet}-{icon}" for icon in range(4)])
+		icons.extend(find_icons(source_file))
+
+	return icons
+
+
+def get_jobs(tmp_path, icons, **kwargs):
+	return collect_jobs(
+			icons,
+			DPIS,
+			str(tmp_path / "output"),
+			["128x128/apps"],
+			downsample=True,
+			output_tree=OutputTree(),
+			**kwargs,
+			)
+
+
+@pytest.mark.parametrize("count", [1, 2, 3, 7])
+def test_select_shard_covers_every_job(tmp_path, icons, count):
+	jobs = get_jobs(tmp_path, icons)
+	shards = [select_shard(jobs, index, count) for index in range(1, count + 1)]
+
+	assert sum(len(shard) for shard in shards) == len(jobs)
+	assert sorted(job.outfile for shard in shards for job in shard) == sorted(job.outfile for job in jobs)
+
+
+@pytest.mark.parametrize("count", [2, 3, 7])
+def test_select_shard_keeps_downsampled_jobs_with_parent(tmp_path, icons, count):
+	jobs = get_jobs(tmp_path, icons)
+	assert any(job.downsample_from is not None for job in jobs)
+
+	for index in range(1, count + 1):
+		shard = select_shard(jobs, index, count)
+		for job in shard:
+			if job.downsample_from is not None:
+				assert job.downsample_from in shard
+
+
+@pytest.mark.parametrize("count", [2, 3, 7])
+def test_select_shard_ignores_what_is_built(tmp_path, icons, count):
+	jobs = get_jobs(tmp_path, icons)
+
+	# Build some of the icons, after the source files were last changed.
+	for job in jobs[::3]:
+		os.makedirs(os.path.dirname(job.outfile), exist_ok=True)
+		with open(job.outfile, "wb"):
+			pass
+		os.utime(job.outfile, ns=(0, os.stat(job.source).st_mtime_ns + 10**9))
+
+	rebuilt_jobs = get_jobs(tmp_path, icons)
+
+	assert [job.stale for job in rebuilt_jobs] != [job.stale for job in jobs]
+
+	for index in range(1, count + 1):
+		assert [job.outfile for job in select_shard(rebuilt_jobs, index, count)] == [
+				job.outfile for job in select_shard(jobs, index, count)
+				]
+
+
+THEME_DIRECTORIES = [
+		"16x16/apps",
+		"22x22/apps",
+		"32x32/apps",
+		"64x64@2x/apps",
+		"24x24@3x/apps",
+		"48x48/actions",
+		"scalable/apps",
+		]
+
+
+def test_get_missing_sizes(tmp_path):
+	icon, = find_icons(write_sheet(tmp_path / "sheet.svg", ["foo"], sizes=[16, 32]))
+	assert get_missing_sizes(icon, [1, 2], THEME_DIRECTORIES) == [(22, 22, 1), (64, 64, 2)]
+
+
+def test_collect_jobs_missing_sizes(tmp_path):
+	icons = find_icons(write_sheet(tmp_path / "sheet.svg", ["foo"], sizes=[16, 32]))
+	output_dir = str(tmp_path / "output")
+
+	jobs = collect_jobs(icons, [1, 2], output_dir, [], theme_directories=THEME_DIRECTORIES)
+	jobs_by_output = {os.path.relpath(job.outfile, output_dir): job for job in jobs}
+
+	assert sorted(jobs_by_output) == [
+			os.path.join("16x16", "apps", "foo.png"),
+			os.path.join("16x16@2x", "apps", "foo.png"),
+			os.path.join("22x22", "apps", "foo.png"),
+			os.path.join("32x32", "apps", "foo.png"),
+			os.path.join("32x32@2x", "apps", "foo.png"),
+			os.path.join("64x64@2x", "apps", "foo.png"),
+			]
+
+	# Rendered from the largest rect, scaled to the size of the output.
+	job = jobs_by_output[os.path.join("22x22", "apps", "foo.png")]
+	assert (job.rect, job.width, job.height) == ("foo-32", 32, 32)
+	assert (job.target_width, job.target_height) == (22, 22)
+	assert job.dpi_factor == 22 / 32
+	assert job.scale == 1
+
+	job = jobs_by_output[os.path.join("64x64@2x", "apps", "foo.png")]
+	assert (job.rect, job.width, job.height) == ("foo-32", 32, 32)
+	assert (job.target_width, job.target_height) == (64, 64)
+	assert job.dpi_factor == 4
+	assert job.scale == 2
+
+	# The rects the icon has are rendered as usual.
+	job = jobs_by_output[os.path.join("16x16@2x", "apps", "foo.png")]
+	assert (job.rect, job.target_width, job.dpi_factor, job.scale) == ("foo-16", 16, 2, 2)
+
+
+def test_collect_jobs_without_theme_directories(tmp_path):
+	icons = find_icons(write_sheet(tmp_path / "sheet.svg", ["foo"], sizes=[16, 32]))
+	jobs = collect_jobs(icons, [1, 2], str(tmp_path / "output"), [])
+	assert sorted((job.target_width, job.scale) for job in jobs) == [(16, 1), (16, 2), (32, 1), (32, 2)]
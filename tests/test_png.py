@@ -0,0 +1,243 @@
+# stdlib
+import struct
+import zlib
+
+# 3rd party
+import pytest
+
+# this package
+from gnome_icon_builder import (
+		PNG_CHANNELS,
+		PNG_SIGNATURE,
+		filter_scanline,
+		filter_scanlines,
+		make_png_chunk,
+		optimize_png_data,
+		read_png_chunks,
+		read_png_pixels,
+		unfilter_scanlines,
+		write_png_pixels
+		)
+
+numpy = pytest.importorskip("numpy")
+
+
+def encode_png(samples, colour_type, chunks=()):
+	"""
+	Encode an array of 8-bit samples as an unoptimised, uncompressed PNG of the given colour type.
+
+	:param chunks: ``(chunk_type, data)`` for each chunk to add between the header and the image data.
+	"""
+
+	height, width = samples.shape[:2]
+	header = struct.pack(">IIBBBBB", width, height, 8, colour_type, 0, 0, 0)
+	image_data = b''.join(b"\x00" + row.tobytes() for row in samples.reshape(height, -1))
+
+	return (
+			PNG_SIGNATURE + make_png_chunk(b"IHDR", header)
+			+ b''.join(make_png_chunk(chunk_type, chunk_data) for chunk_type, chunk_data in chunks)
+			+ make_png_chunk(b"IDAT", zlib.compress(image_data, 0)) + make_png_chunk(b"IEND", b'')
+			)
+
+
+def get_header(data):
+	width, height, bit_depth, colour_type, *_ = struct.unpack(">IIBBBBB", read_png_chunks(data)[0][1])
+	return colour_type, bit_depth
+
+
+def to_rgba(samples, colour_type):
+	if colour_type == 0:
+		samples = samples.reshape(*samples.shape[:2], 1)
+		return numpy.dstack([samples, samples, samples, numpy.full_like(samples, 255)])
+	elif colour_type == 2:
+		return numpy.dstack([samples, numpy.full_like(samples[..., :1], 255)])
+	elif colour_type == 4:
+		return numpy.dstack([samples[..., :1], samples[..., :1], samples[..., :1], samples[..., 1:]])
+	else:
+		return samples
+
+
+@pytest.mark.parametrize("bpp", [1, 2, 3, 4, 8])
+@pytest.mark.parametrize("filter_type", [0, 1, 2, 3, 4])
+def test_unfilter_scanlines(bpp, filter_type):
+	rng = numpy.random.RandomState(filter_type * 10 + bpp)
+	stride = bpp * 13
+	rows = [rng.randint(0, 256, stride, dtype=numpy.uint8).tobytes() for _ in range(7)]
+
+	raw = bytearray()
+	prior = bytes(stride)
+	for line in rows:
+		raw.append(filter_type)
+		raw += filter_scanline(filter_type, line, prior, bpp)
+		prior = line
+
+	assert unfilter_scanlines(bytes(raw), len(rows), stride, bpp) == rows
+
+
+@pytest.mark.parametrize("adaptive", [True, False])
+@pytest.mark.parametrize("bpp", [1, 2, 4])
+def test_filter_scanlines_round_trip(adaptive, bpp):
+	rng = numpy.random.RandomState(bpp)
+	stride = bpp * 16
+
+	# A gradient, so the adaptive filters have something to work with, with some noise.
+	gradient = numpy.add.outer(numpy.arange(9), numpy.arange(stride)).astype(numpy.uint8)
+	noise = rng.randint(0, 4, gradient.shape).astype(numpy.uint8)
+	rows = [row.tobytes() for row in gradient + noise]
+
+	assert unfilter_scanlines(filter_scanlines(rows, bpp, adaptive), len(rows), stride, bpp) == rows
+
+
+@pytest.mark.parametrize("colour_type", [0, 2, 4, 6])
+def test_read_png_pixels(colour_type):
+	rng = numpy.random.RandomState(colour_type)
+	samples = rng.randint(0, 256, (5, 7, PNG_CHANNELS[colour_type]), dtype=numpy.uint8)
+
+	pixels = read_png_pixels(encode_png(samples, colour_type))
+
+	assert pixels.shape == (5, 7, 4)
+	assert (pixels == to_rgba(samples, colour_type)).all()
+
+
+def test_write_png_pixels(tmp_path):
+	rng = numpy.random.RandomState(0)
+	pixels = rng.randint(0, 256, (6, 9, 4), dtype=numpy.uint8)
+
+	write_png_pixels(tmp_path / "image.png", pixels)
+
+	assert (read_png_pixels((tmp_path / "image.png").read_bytes()) == pixels).all()
+
+
+def many_colours(colour_type, opaque=False):
+	# More than 256 distinct colours, so the image can't be reduced to a palette.
+	height, width = 24, 32
+	values = numpy.arange(height * width, dtype=numpy.uint32)
+	samples = numpy.zeros((height, width, PNG_CHANNELS[colour_type]), dtype=numpy.uint8)
+
+	samples[..., 0] = (values % 256).reshape(height, width)
+	if PNG_CHANNELS[colour_type] > 2:
+		samples[..., 1] = (values // 256 * 40).reshape(height, width)
+		samples[..., 2] = (values * 7 % 256).reshape(height, width)
+	if colour_type in {4, 6}:
+		samples[..., -1] = 255 if opaque else (values // 3 % 256).reshape(height, width)
+
+	return samples
+
+
+@pytest.mark.parametrize(
+		"colour_type, opaque, expected",
+		[
+				pytest.param(6, False, (6, 8), id="rgba"),
+				pytest.param(4, False, (4, 8), id="grey_alpha"),
+				pytest.param(6, True, (2, 8), id="rgba_opaque"),
+				pytest.param(2, True, (2, 8), id="rgb"),
+				],
+		)
+def test_optimize_png_data_many_colours(colour_type, opaque, expected):
+	samples = many_colours(colour_type, opaque)
+	data = encode_png(samples, colour_type)
+
+	for effort in ("fast", "release"):
+		optimized = optimize_png_data(data, effort)
+
+		assert len(optimized) < len(data)
+		assert get_header(optimized) == expected
+		assert (read_png_pixels(optimized) == to_rgba(samples, colour_type)).all()
+
+
+@pytest.mark.parametrize(
+		"colours, bit_depth",
+		[
+				pytest.param(2, 1, id="1bit"),
+				pytest.param(4, 2, id="2bit"),
+				pytest.param(16, 4, id="4bit"),
+				pytest.param(200, 8, id="8bit"),
+				pytest.param(256, 8, id="256"),
+				],
+		)
+@pytest.mark.parametrize("colour_type", [2, 4, 6])
+def test_optimize_png_data_palette(colours, bit_depth, colour_type):
+	rng = numpy.random.RandomState(colours)
+	channels = PNG_CHANNELS[colour_type]
+
+	# Distinct colours, some of them partly or fully transparent.
+	palette = numpy.zeros((colours, channels), dtype=numpy.uint8)
+	palette[:, 0] = numpy.arange(colours)
+	if channels > 2:
+		palette[:, 1:] = rng.randint(0, 256, (colours, channels - 1), dtype=numpy.uint8)
+	if colour_type in {4, 6}:
+		palette[:, -1] = rng.choice([0, 128, 255], colours)
+		palette[0, -1] = 0
+
+	# Odd widths, so the last byte of each packed row is only partly used.
+	indices = rng.randint(0, colours, (41, 63))
+	indices.flat[:colours] = numpy.arange(colours)
+	samples = palette[indices]
+	data = encode_png(samples, colour_type)
+
+	for effort in ("fast", "release"):
+		optimized = optimize_png_data(data, effort)
+
+		assert get_header(optimized) == (3, bit_depth)
+		assert (read_png_pixels(optimized) == to_rgba(samples, colour_type)).all()
+
+
+def few_colours(colour_type):
+	rng = numpy.random.RandomState(colour_type)
+	palette = rng.randint(0, 256, (16, PNG_CHANNELS[colour_type]), dtype=numpy.uint8)
+	palette[:, 0] = numpy.arange(16)
+	return palette[rng.randint(0, 16, (32, 32))]
+
+
+COLOUR_CHUNKS = [
+		(b"sRGB", b"\x00"),
+		(b"gAMA", struct.pack(">I", 45455)),
+		(b"cHRM", struct.pack(">8I", 31270, 32900, 64000, 33000, 30000, 60000, 15000, 6000)),
+		(b"iCCP", b"profile\x00\x00" + zlib.compress(b"not really a profile")),
+		]
+
+
+@pytest.mark.parametrize(
+		"samples, colour_type, significant_bits, expected_colour_type, expected_significant_bits",
+		[
+				pytest.param(few_colours(6), 6, b"\x05\x06\x07\x08", 3, b"\x05\x06\x07", id="rgba_to_palette"),
+				pytest.param(few_colours(4), 4, b"\x05\x08", 3, b"\x05\x05\x05", id="grey_alpha_to_palette"),
+				pytest.param(few_colours(2), 2, b"\x05\x06\x07", 3, b"\x05\x06\x07", id="rgb_to_palette"),
+				pytest.param(many_colours(6, opaque=True), 6, b"\x05\x06\x07\x08", 2, b"\x05\x06\x07", id="drop_alpha"),
+				],
+		)
+def test_optimize_png_data_keeps_colour_chunks(
+		samples,
+		colour_type,
+		significant_bits,
+		expected_colour_type,
+		expected_significant_bits,
+		):
+	data = encode_png(samples, colour_type, [*COLOUR_CHUNKS, (b"sBIT", significant_bits)])
+
+	optimized = optimize_png_data(data)
+	chunks = read_png_chunks(optimized)
+
+	assert get_header(optimized)[0] == expected_colour_type
+	assert [chunk_type for chunk_type, _ in chunks if chunk_type not in {b"PLTE", b"tRNS"}] == [
+			b"IHDR", *(chunk_type for chunk_type, _ in COLOUR_CHUNKS), b"sBIT", b"IDAT", b"IEND"
+			]
+	assert chunks[1:len(COLOUR_CHUNKS) + 1] == COLOUR_CHUNKS
+	assert dict(chunks)[b"sBIT"] == expected_significant_bits
+	assert (read_png_pixels(optimized) == to_rgba(samples, colour_type)).all()
+
+
+def test_optimize_png_data_strips_chunks():
+	samples = many_colours(6)
+	data = encode_png(samples, 6)
+	data = data[:-12] + make_png_chunk(b"tEXt", b"Comment\x00hello") + data[-12:]
+
+	optimized = optimize_png_data(data)
+
+	assert b"tEXt" not in [chunk_type for chunk_type, _ in read_png_chunks(optimized)]
+	assert (read_png_pixels(optimized) == samples).all()
+
+
+def test_optimize_png_data_none_effort():
+	data = encode_png(many_colours(6), 6)
+	assert optimize_png_data(data, "none") is data
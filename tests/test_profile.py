@@ -0,0 +1,39 @@
+# stdlib
+import json
+
+# this package
+from gnome_icon_builder import BuildProfile, write_plan
+
+
+def test_write_appends_within_build(tmp_path):
+	profile_file = tmp_path / "profile.json"
+	profile_file.write_text("left over from an earlier build\n", encoding="UTF-8")
+
+	profile = BuildProfile()
+	profile.add({
+			"icon": "foo.png",
+			"stage": "render",
+			"wall_time": 1.0,
+			"subprocess_time": 0.5,
+			"bytes_in": 100,
+			"bytes_out": 10,
+			"cache_hit": False,
+			})
+	profile.write(profile_file)
+	profile.write(profile_file)
+
+	lines = profile_file.read_text(encoding="UTF-8").splitlines()
+	assert len(lines) == 2
+	assert json.loads(lines[0])["records"][0]["icon"] == "foo.png"
+
+
+def test_write_independent_of_plan(tmp_path):
+	output_file = tmp_path / "output.json"
+
+	write_plan({"jobs": []}, output_file)
+	BuildProfile().write(output_file)
+
+	# The plan written first doesn't make the profile be added to the end of the file.
+	lines = output_file.read_text(encoding="UTF-8").splitlines()
+	assert len(lines) == 1
+	assert "records" in json.loads(lines[0])
@@ -0,0 +1,231 @@
+# stdlib
+import textwrap
+import xml.sax
+
+# 3rd party
+import pytest
+
+# this package
+from gnome_icon_builder import SourceSheetIndex
+
+SHEET = textwrap.dedent(
+		"""\
+		<svg xmlns="http://www.w3.org/2000/svg" xmlns:inkscape="http://www.inkscape.org/namespaces/inkscape">
+			<defs id="defs"><linearGradient id="gradient"><stop offset="0" style="stop-color:#729fcf"/></linearGradient></defs>
+			<g id="baseplate-a" inkscape:groupmode="layer" inkscape:label="baseplate">
+				<text inkscape:label="context">apps</text>
+				<text inkscape:label="icon-name">icon-a</text>
+				<rect id="rect-a" x="0" y="0" width="16" height="16"/>
+			</g>
+			<g id="baseplate-b" inkscape:groupmode="layer" inkscape:label="baseplate">
+				<text inkscape:label="context">apps</text>
+				<text inkscape:label="icon-name">icon-b</text>
+				<rect id="rect-b" x="32" y="0" width="16" height="16"/>
+			</g>
+			<g id="layer-a" inkscape:groupmode="layer" inkscape:label="icon-a">
+				<path id="path-a" d="M 0,0 H 16 V 16 Z"/>
+			</g>
+			<g id="shared" inkscape:groupmode="layer" inkscape:label="background">
+				<rect id="shadow" x="0" y="0" width="48" height="16"/>
+			</g>
+			<g id="layer-b" inkscape:groupmode="layer" inkscape:label="icon-b">
+				<path id="path-b" d="M 32,0 H 48 V 16 Z"/>
+			</g>
+		</svg>
+		"""
+		)
+
+
+class ContentHandler(xml.sax.ContentHandler):
+	"""
+	How baseplates were found before :class:`SourceSheetIndex`, which it should still agree with.
+	"""
+
+	ROOT = 0
+	SVG = 1
+	LAYER = 2
+	OTHER = 3
+	TEXT = 4
+
+	def __init__(self):
+		self.stack = [self.ROOT]
+		self.inside = [self.ROOT]
+		self.rects = []
+		self.chars = ''
+		self.icons = []
+
+	def startElement(self, name, attrs):
+		if self.inside[-1] == self.ROOT:
+			if name == "svg":
+				self.stack.append(self.SVG)
+				self.inside.append(self.SVG)
+				return
+		elif self.inside[-1] == self.SVG:
+			if (
+					name == 'g' and "inkscape:groupmode" in attrs and "inkscape:label" in attrs
+					and attrs["inkscape:groupmode"] == "layer"
+					and attrs["inkscape:label"].lower().startswith("baseplate")
+					):
+				self.stack.append(self.LAYER)
+				self.inside.append(self.LAYER)
+				self.context = None
+				self.icon_name = None
+				self.rects = []
+				return
+		elif self.inside[-1] == self.LAYER:
+			if name == "text" and attrs.get("inkscape:label") in {"context", "icon-name"}:
+				self.stack.append(self.TEXT)
+				self.inside.append(self.TEXT)
+				self.text = attrs["inkscape:label"]
+				self.chars = ''
+				return
+			elif name == "rect":
+				self.rects.append(attrs["id"])
+
+		self.stack.append(self.OTHER)
+
+	def endElement(self, name):
+		stacked = self.stack.pop()
+
+		if self.inside[-1] == stacked:
+			self.inside.pop()
+
+		if stacked == self.TEXT:
+			if self.text == "context":
+				self.context = self.chars
+			else:
+				self.icon_name = self.chars
+		elif stacked == self.LAYER:
+			self.icons.append((self.context, self.icon_name, self.rects))
+
+	def characters(self, chars):
+		self.chars += chars.strip()
+
+
+def get_index(tmp_path, sheet):
+	source_file = tmp_path / "sheet.svg"
+	source_file.write_text(sheet, encoding="UTF-8")
+	return SourceSheetIndex(source_file)
+
+
+@pytest.mark.parametrize(
+		"old, new, changed",
+		[
+				pytest.param("M 0,0 H 16", "M 0,0 H 15", {"icon-a"}, id="icon_layer"),
+				pytest.param("M 32,0 H 48", "M 32,0 H 47", {"icon-b"}, id="other_icon_layer"),
+				pytest.param('width="48"', 'width="47"', {"icon-a", "icon-b"}, id="shared_layer"),
+				pytest.param("#729fcf", "#729fd0", {"icon-a", "icon-b"}, id="defs"),
+				pytest.param('id="rect-b" x="32"', 'id="rect-b" x="31"', {"icon-a", "icon-b"}, id="baseplate"),
+				],
+		)
+def test_png_digests(tmp_path, old, new, changed):
+	before = get_index(tmp_path, SHEET).png_digests
+	after = get_index(tmp_path, SHEET.replace(old, new)).png_digests
+
+	assert {icon_name for icon_name in before if before[icon_name] != after[icon_name]} == changed
+
+
+def test_png_digests_differ_between_icons(tmp_path):
+	png_digests = get_index(tmp_path, SHEET).png_digests
+	assert png_digests["icon-a"] != png_digests["icon-b"]
+
+
+NESTED_SHEETS = [
+		pytest.param(
+				"""
+				<g inkscape:groupmode="layer" inkscape:label="icons">
+					<g inkscape:groupmode="layer" inkscape:label="baseplate">
+						<text inkscape:label="context">apps</text>
+						<text inkscape:label="icon-name">foo</text>
+						<rect id="rect-16" width="16" height="16"/>
+					</g>
+				</g>
+				""",
+				id="layer_in_layer",
+				),
+		pytest.param(
+				"""
+				<g id="group">
+					<g inkscape:groupmode="layer" inkscape:label="Baseplate 1">
+						<text inkscape:label="context">apps</text>
+						<text inkscape:label="icon-name">foo</text>
+						<rect id="rect-16" width="16" height="16"/>
+					</g>
+				</g>
+				""",
+				id="layer_in_group",
+				),
+		pytest.param(
+				"""
+				<g inkscape:groupmode="layer" inkscape:label="baseplate">
+					<text inkscape:label="context">apps</text>
+					<text inkscape:label="icon-name">foo</text>
+					<rect id="rect-16" width="16" height="16"/>
+					<g inkscape:groupmode="layer" inkscape:label="baseplate">
+						<text inkscape:label="icon-name">bar</text>
+						<rect id="rect-32" width="32" height="32"/>
+					</g>
+				</g>
+				""",
+				id="baseplate_in_baseplate",
+				),
+		pytest.param(
+				"""
+				<g inkscape:groupmode="layer" inkscape:label="baseplate">
+					<g inkscape:groupmode="layer" inkscape:label="labels">
+						<text inkscape:label="context"><tspan>apps</tspan></text>
+						<text inkscape:label="icon-name">
+							<tspan>edit-</tspan>
+							<tspan>copy</tspan>
+						</text>
+					</g>
+					<g><g><rect id="rect-16" width="16" height="16"/></g></g>
+				</g>
+				""",
+				id="text_in_tspans",
+				),
+		pytest.param(
+				"""
+				<g inkscape:groupmode="layer" inkscape:label="baseplate">
+					<text inkscape:label="context">apps<rect id="in-context" width="1" height="1"/></text>
+					<text inkscape:label="icon-name">foo</text>
+					<text inkscape:label="size">16<rect id="in-other-text" width="1" height="1"/></text>
+					<rect id="rect-16" width="16" height="16"/>
+				</g>
+				""",
+				id="rects_in_text",
+				),
+		pytest.param(
+				"""
+				<g inkscape:groupmode="layer" inkscape:label="artwork">
+					<rect id="not-a-baseplate" width="16" height="16"/>
+				</g>
+				<g inkscape:groupmode="layer" inkscape:label="baseplate">
+					<text inkscape:label="context">apps</text>
+					<text inkscape:label="icon-name">foo</text>
+					<rect id="rect-16" width="16" height="16"/>
+				</g>
+				<g inkscape:groupmode="layer" inkscape:label="baseplate">
+					<text inkscape:label="context">actions</text>
+					<text inkscape:label="icon-name">bar</text>
+					<rect id="rect-32" width="32" height="32"/>
+				</g>
+				""",
+				id="several",
+				),
+		]
+
+
+@pytest.mark.parametrize("body", NESTED_SHEETS)
+def test_icons_match_sax(tmp_path, body):
+	sheet = (
+			'<svg xmlns="http://www.w3.org/2000/svg" xmlns:inkscape="http://www.inkscape.org/namespaces/inkscape">'
+			f"{body}</svg>"
+			)
+	index = get_index(tmp_path, sheet)
+
+	handler = ContentHandler()
+	xml.sax.parse(str(tmp_path / "sheet.svg"), handler)
+
+	assert handler.icons
+	assert [(icon.context, icon.icon_name, [rect["id"] for rect in icon.rects]) for icon in index.icons] == handler.icons
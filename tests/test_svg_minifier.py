@@ -0,0 +1,16 @@
+# this package
+from gnome_icon_builder import SVGMinifier
+
+SVG = '<svg xmlns="http://www.w3.org/2000/svg" width="16" height="16"><rect width="16" height="16"/></svg>'
+
+
+def test_processes_started_on_first_submit(tmp_path):
+	with SVGMinifier(2) as minifier:
+		assert minifier._processes is None
+
+		svg_file = tmp_path / "icon.svg"
+		svg_file.write_text(SVG, encoding="UTF-8")
+		minifier.submit(svg_file).result()
+
+		assert minifier._processes is not None
+